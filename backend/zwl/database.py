@@ -9,8 +9,12 @@
     :license: GNU GPL 2.0 or later.
 """
 
+import sqlite3
+import zlib
+from collections import OrderedDict
 from datetime import datetime
-from sqlalchemy import TypeDecorator
+from sqlalchemy import TypeDecorator, cast, event, func
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql.functions import coalesce
 from zwl import app, db
@@ -135,3 +139,125 @@ class MinimumStopTime(db.Model):
         if result is None:
             raise ValueError('No minimum stop time defined')
         return result
+
+
+class MinimumStopTimeTable(object):
+    """
+    In-memory copy of the `MinimumStopTime` table.
+
+    `lookup()` gives the same results as `MinimumStopTime.lookup()`, but the
+    table is only read once (on the first lookup), and results are cached.
+    Call `invalidate()` to read the table again on the next lookup.
+    """
+    def __init__(self):
+        self.rows = None
+        self._results = {}
+
+    def load(self):
+        self.rows = [tuple(row) for row in db.session.query(
+                MinimumStopTime.traintype_id, MinimumStopTime.loc,
+                MinimumStopTime.track, MinimumStopTime.minimum_stop_time)
+            .order_by(MinimumStopTime.id)]
+        self._results = {}
+
+    def invalidate(self):
+        self.rows = None
+        self._results = {}
+
+    def lookup(self, traintype, loc, track=None):
+        """
+        Find the minimum stopping time for a train of type `traintype` at
+        `loc` and (optionally) `track`. See `MinimumStopTime.lookup()`.
+        """
+        if isinstance(traintype, Train):
+            traintype = traintype.type_id
+        elif isinstance(traintype, TrainType):
+            traintype = traintype.id
+        if track is not None and loc is None:
+            raise ValueError('loc cannot be None when track is not')
+
+        key = (traintype, loc, track)
+        try:
+            return self._results[key]
+        except KeyError:
+            pass
+
+        if self.rows is None:
+            self.load()
+
+        # emulate the ordering used in `MinimumStopTime.lookup()`, including
+        # SQL's handling of NULL. `max` returns the first of several equally
+        # ranked rows.
+        def _rank(row):
+            r_traintype, r_loc, r_track, _ = row
+            rank = []
+            if track is not None:
+                rank.append(_sql_and(_sql_eq(r_loc, loc),
+                                     _sql_eq(r_track, track)))
+            rank.append(_sql_and(_sql_eq(r_loc, loc), r_track is None))
+            rank.append(_sql_eq(r_traintype, traintype))
+            return [0.5 if r is None else float(r) for r in rank]
+
+        result = max(self.rows, key=_rank)[3] if self.rows else None
+        if result is None:
+            raise ValueError('No minimum stop time defined')
+
+        self._results[key] = result
+        return result
+
+def _sql_eq(a, b):
+    """`a = b` in SQL, where SQLAlchemy turns `== None` into `IS NULL`."""
+    if b is None:
+        return a is None
+    if a is None:
+        return None
+    return a == b
+
+def _sql_and(a, b):
+    """`a AND b` in SQL, with None meaning NULL."""
+    if a is False or b is False:
+        return False
+    if a is None or b is None:
+        return None
+    return True
+
+
+def checksum(*columns):
+    """
+    Get a value that changes whenever the values in any of the given
+    columns change, in any row. This is a lot cheaper than loading the data,
+    though it still takes a full scan of the tables.
+
+    Computed as the number of rows plus the sum of the CRC32 of the values of
+    every row, per table.
+
+    :param columns: mapped attributes, e.g. `Train.nr`
+    """
+    tables = OrderedDict()
+    for column in columns:
+        tables.setdefault(column.class_, []).append(column)
+
+    subqueries = []
+    for model, columns in tables.items():
+        text = None
+        for column in columns:
+            value = coalesce(cast(column, db.String), '')
+            text = value if text is None else text + ',' + value
+        subqueries.append(db.session.query(func.count()).select_from(model)
+                          .as_scalar().label('%s_count' % model.__name__))
+        subqueries.append(db.session.query(func.sum(func.crc32(text)))
+                          .as_scalar().label('%s_crc' % model.__name__))
+    return tuple(db.session.query(*subqueries).one())
+
+@event.listens_for(Engine, 'connect')
+def _add_sqlite_functions(dbapi_connection, connection_record):
+    # MySQL has this built in, see `checksum()`
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('crc32', 1, _crc32)
+
+def _crc32(value):
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return zlib.crc32(value) & 0xffffffff
@@ -37,6 +37,23 @@ RESPONSE_DELAY = 0
 # timetable data.
 REFRESH_INTERVAL = 15
 
+# Number of graph data responses (per line, time window and position range)
+# to keep in memory. Cached responses are dropped as soon as the timetable
+# changes. 0 disables the cache.
+GRAPHDATA_CACHE_SIZE = 128
+
+# Time windows requested by the frontend are widened to multiples of this
+# (seconds) for caching, so requests differing by a few seconds share a
+# cached response.
+GRAPHDATA_CACHE_QUANTUM = 60
+
+# Number of seconds (int or float) to rely on the last check for timetable
+# changes. Checking takes a scan of the timetable, which costs about as much
+# as answering a request without the cache (notably with SQLite), so it is
+# done only once in a while, at the price of slightly outdated responses.
+# 0 means checking on every request.
+GRAPHDATA_CACHE_CHECK_INTERVAL = 1
+
 # Link that is opened when a train number is clicked
 TIMETABLE_URL_TEMPLATE = 'http://www.ebuef/webstw/includes/popup_fahrplan.php?theme=dark&search=hide&zid={id}'
 
@@ -46,6 +63,47 @@ TIMETABLE_URL_TEMPLATE = 'http://www.ebuef/webstw/includes/popup_fahrplan.php?th
 # Limit for the train time prediction (seconds from current time)
 PREDICTION_INTERVAL = 7200 # 2h
 
+# Part of the prediction horizon (seconds from current time) that is
+# recomputed on every run. Trains running later are only recomputed every
+# PREDICTION_FAR_REFRESH_INTERVAL seconds (simulation time), their
+# predictions are kept in between. If None, the whole horizon is recomputed
+# on every run.
+PREDICTION_NEAR_HORIZON = 1800 # 30min
+PREDICTION_FAR_REFRESH_INTERVAL = 300 # 5min
+
+# Whether to update the predictions periodically in a background thread.
+# The thread is started on the first request. If the application runs in
+# several processes, this should be enabled in one of them only.
+PREDICTION_SCHEDULER = True
+
+# Number of processes to use for the prediction. Trains that don't share any
+# tracks are distributed among them. The processes are started once, along
+# with the scheduler, and kept running.
+PREDICTION_PROCESSES = 1
+
+# Maximum duration (seconds, wall clock time) of the simulation in a
+# prediction run. If it is exceeded, the simulation is stopped and the
+# predictions computed so far are written, which are the earliest ones.
+# The trains not simulated completely are listed in the statistics and
+# simulated again in the next run. To get a refresh in every cycle, set it to
+# somewhat less than the refresh interval. None means no limit.
+PREDICTION_TIME_BUDGET = None
+
+# Maximum number of simulation steps of a prediction run (per process), see
+# PREDICTION_TIME_BUDGET. None means no limit.
+PREDICTION_STEP_BUDGET = None
+
+# Whether to collect statistics (counters and timings) of prediction runs,
+# see /predict/stats.
+PREDICTION_STATS = True
+
+# Whether to write these statistics to the log after every run.
+PREDICTION_STATS_LOG = False
+
+# Number of seconds between two prediction updates. If None, the frontend's
+# REFRESH_INTERVAL is used.
+PREDICTION_REFRESH_INTERVAL = None
+
 # If is no minimal travel time given in the timetable, we approximate
 # this assuming a constant factor.
 # For example, with a ratio of 0.8 and a travel time of five minutes in the
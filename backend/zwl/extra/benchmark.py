@@ -0,0 +1,262 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+"""
+    zwl.extra.benchmark
+    ===================
+
+    Benchmark for the prediction engine, usable for development.
+
+    Creates a number of synthetic journeys (without touching the database)
+    and measures how many steps per second `Manager.simulate` processes.
+    The journeys form groups of a few trains each, which share no elements
+    with other groups, so they can be distributed among several processes.
+
+    With `--session`, a synthetic session (see `zwl.extra.generate`) is
+    created in a temporary SQLite database, and the prediction is timed end
+    to end and per phase, as well as `get_train_information` for every
+    lineconfig, and all lineconfigs' graph data answered from the cache.
+
+    Results can be saved as JSON (`--output`) and compared against results
+    saved earlier (`--baseline`).
+
+    :copyright: (c) 2015, Marian Sigler
+    :license: GNU GPL 2.0 or later.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from datetime import date, datetime, time, timedelta
+from time import time as ttime
+from zwl import app, db
+from zwl.database import Train, TrainType, TimetableEntry
+from zwl.extra.generate import generate_session
+from zwl.lines import lineconfigs
+from zwl.predict import Action, Journey, Manager, Predictor
+from zwl.trains import get_train_information, get_graph_data, \
+        graphdata_cache, train_ids_query
+
+DEFAULT_SIZES = (100, 1000, 5000)
+
+def make_journeys(n, now=time(8,0), stops=10, group_size=4):
+    """
+    Create `n` journeys, each running over `stops` locations.
+
+    Trains are organized in groups of `group_size` trains sharing the same
+    route, following each other closely enough to provoke some conflicts.
+    """
+    traintype = TrainType(id=1, name='RB')
+    start = datetime.combine(date(1,1,1), now)
+    journeys = []
+
+    for i in range(n):
+        group, member = divmod(i, group_size)
+        train = Train(id=i+1, nr=10000+i, type_obj=traintype)
+
+        t = start + timedelta(seconds=(group % 60)*30 + member*90)
+        timetable = []
+        for s in range(stops):
+            arr = t.time() if s > 0 else None
+            if s > 0 and s < stops-1:
+                t += timedelta(seconds=30)
+            dep = t.time() if s < stops-1 else None
+            timetable.append(TimetableEntry(train_id=train.id,
+                loc='B%dS%d' % (group, s), track_want=1, min_stoptime=20,
+                arr_want=arr, dep_want=dep, sorttime=arr or dep))
+            t += timedelta(seconds=120)
+
+        journeys.append(Journey(train, now, timetable))
+
+    return journeys
+
+def benchmark(n, processes=1):
+    """
+    Run the prediction for `n` synthetic journeys.
+
+    :return: tuple `(steps, seconds)`
+    """
+    now = time(8,0)
+    manager = Manager(make_journeys(n, now), now, processes)
+
+    if processes > 1:
+        # steps taken in other processes are not counted
+        start = ttime()
+        manager.simulate()
+        return None, ttime() - start
+
+    steps = [0]
+    allocate = Action.allocate
+    def _counting_allocate(self, manager):
+        steps[0] += 1
+        return allocate(self, manager)
+
+    Action.allocate = _counting_allocate
+    try:
+        start = ttime()
+        manager.simulate()
+        duration = ttime() - start
+    finally:
+        Action.allocate = allocate
+
+    return steps[0], duration
+
+def benchmark_session(trains, now=time(12,0), seed=1, repeat=3):
+    """
+    Run the prediction and `get_train_information` on a synthetic session
+    of `trains` trains, which is created in a temporary SQLite database.
+
+    Every measurement is repeated `repeat` times, the best time is reported.
+
+    :return: dict of the form {name: seconds}
+    """
+    fd, path = tempfile.mkstemp(suffix='.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % path
+    app.config['PREDICTION_STATS'] = True
+    try:
+        db.create_all()
+        generate_session(trains, now=now, seed=seed)
+        db.session.commit()
+        return _benchmark_session(now, repeat)
+    finally:
+        db.session.remove()
+        db.engine.dispose()
+        os.close(fd)
+        os.unlink(path)
+
+def _benchmark_session(now, repeat):
+    results = {}
+    def _record(name, seconds):
+        results[name] = min(results.get(name, seconds), seconds)
+
+    for _ in range(repeat):
+        # a full run, the predictor doesn't know anything yet
+        predictor = Predictor()
+        start = ttime()
+        manager = predictor.run(now)
+        db.session.commit()
+        _record('predict.total', ttime() - start)
+        for name, seconds in manager.stats.timings.items():
+            _record('predict.%s' % name, seconds)
+
+        # nothing changed, so nothing needs to be simulated
+        start = ttime()
+        predictor.run(now)
+        db.session.commit()
+        _record('predict.unchanged', ttime() - start)
+
+        # a minute later, most trains are simulated again with the journey
+        # plans of the first run
+        later = (datetime.combine(date(1,1,1), now)
+                 + timedelta(minutes=1)).time()
+        start = ttime()
+        predictor.run(later)
+        db.session.commit()
+        _record('predict.later', ttime() - start)
+
+        # what the frontend requests: one hour on every line
+        end = (datetime.combine(date(1,1,1), now) + timedelta(hours=1)).time()
+        for id, line in sorted(lineconfigs.items()):
+            db.session.expire_all()
+            start = ttime()
+            ids = train_ids_query(now, end, line)
+            list(get_train_information(ids, line))
+            _record('graphdata.%s' % id, ttime() - start)
+
+        # the same requests again, answered from the cache
+        graphdata_cache.clear()
+        for id, line in sorted(lineconfigs.items()):
+            get_graph_data(line, now, end)
+        start = ttime()
+        for id, line in sorted(lineconfigs.items()):
+            get_graph_data(line, now, end)
+        _record('graphdata.cached', ttime() - start)
+
+    results['predict.trains'] = manager.stats.trains
+    results['predict.actions'] = manager.stats.actions
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Print `results` next to `baseline`.
+
+    :return: names of the timings that are slower than the baseline by more
+             than `tolerance` (relative)
+    """
+    regressions = []
+    print '%-32s %10s %10s %8s' % ('', 'baseline', 'current', 'change')
+    for name in sorted(set(results) | set(baseline)):
+        old = baseline.get(name)
+        new = results.get(name)
+        if old is None or new is None:
+            print '%-32s %10s %10s' % (name, _format(old), _format(new))
+            continue
+        change = (new - old) / float(old) if old else 0
+        print '%-32s %10s %10s %+7.1f%%' % (name, _format(old), _format(new),
+                                            change * 100)
+        if isinstance(new, float) and change > tolerance:
+            regressions.append(name)
+    return regressions
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.4f' % value
+    return str(value)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the prediction.')
+    parser.add_argument('sizes', metavar='N', type=int, nargs='*',
+                        default=DEFAULT_SIZES, help='number of journeys')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='number of processes to use')
+    parser.add_argument('-s', '--session', metavar='TRAINS', type=int,
+                        help='benchmark a synthetic session of that many '
+                             'trains instead of single journeys')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of repetitions (session benchmark)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='save the results as JSON')
+    parser.add_argument('-b', '--baseline', metavar='FILE',
+                        help='compare against results saved earlier')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='allowed slowdown against the baseline '
+                             '(default: 0.1, i.e. 10%%)')
+    args = parser.parse_args()
+
+    # the database is not used, but the session needs to be set up
+    if app.config['SQLALCHEMY_DATABASE_URI'] is None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+
+    results = {}
+    if args.session is not None:
+        results = benchmark_session(args.session, repeat=args.repeat)
+        for name, value in sorted(results.items()):
+            print '%-32s %10s' % (name, _format(value))
+    else:
+        print '%8s %10s %10s %12s' % ('journeys', 'steps', 'seconds',
+                                      'steps/s')
+        for n in args.sizes:
+            steps, duration = benchmark(n, args.processes)
+            results['simulate.%d' % n] = duration
+            if steps is None:
+                print '%8d %10s %10.3f %12s' % (n, '-', duration, '-')
+            else:
+                results['simulate.%d.steps' % n] = steps
+                print '%8d %10d %10.3f %12.0f' % (n, steps, duration,
+                                                  steps/duration)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print
+            print 'slower than the baseline: %s' % ', '.join(regressions)
+            sys.exit(1)
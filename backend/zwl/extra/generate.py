@@ -0,0 +1,312 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+"""
+    zwl.extra.generate
+    ==================
+
+    Generator for synthetic sessions, usable for development and
+    benchmarking.
+
+    Fills the database with train types, minimum stop times and trains
+    running along the routes of the existing lineconfigs. Trains are
+    scheduled throughout the day, some of them are delayed, and trains that
+    have already started have real arrival and departure times up to the
+    session's current time.
+
+    :copyright: (c) 2015, Marian Sigler
+    :license: GNU GPL 2.0 or later.
+"""
+import argparse
+import random
+from datetime import time
+from zwl import app, db
+from zwl.database import Train, TrainType, TimetableEntry, MinimumStopTime
+from zwl.lines import lineconfigs, Signal, Station, Stop
+from zwl.utils import time2seconds, seconds2time
+
+# name, category, minimum stop time, first train number
+TRAIN_TYPES = (
+    ('ICE', 'fv', 60, 500),
+    ('IC', 'fv', 60, 2000),
+    ('RE', 'nv', 30, 4000),
+    ('RB', 'nv', 20, 16000),
+    ('GC', 'gv', 120, 40000),
+    ('Lz', 'lz', 30, 70000),
+)
+
+# tracks used by trains running in either direction: the first one at
+# locations other than stations, any of them in stations. Trains in opposite
+# directions never use the same track, as the prediction cannot resolve
+# trains meeting on a single track line.
+TRACKS = {'right': (1, 3), 'left': (2, 4)}
+
+def get_routes():
+    """
+    Get the routes trains can run on: for each lineconfig and direction, the
+    list of its locations in the order they are passed. Each location
+    appears only once, and only signals valid for the direction are used.
+
+    :return: dict of the form {(lineconfig id, direction): list of `Loc`}
+    """
+    routes = {}
+    known = set()
+    # original lineconfigs first, see `zwl.lines.add_lineconfig`
+    for id in sorted(lineconfigs, key=lambda id: (id.startswith('-'), id)):
+        line = lineconfigs[id]
+        if id == 'sample':
+            # the sample line doesn't match the other lines' geography
+            continue
+        codes = tuple(line.locationcodes)
+        if codes[::-1] in known:
+            # reversed lineconfigs only duplicate the original ones
+            continue
+        known.add(codes)
+
+        seen = set()
+        locations = []
+        for loc in line.locations:
+            if loc.code in seen:
+                # a ring: trains pass every location only once
+                break
+            seen.add(loc.code)
+            locations.append(loc)
+
+        for direction, locs in (('right', locations),
+                                ('left', locations[::-1])):
+            route = [l for l in locs if not isinstance(l, Signal)
+                     or l.direction in (direction, 'both')]
+            if len(route) >= 2:
+                routes[id, direction] = route
+    return routes
+
+def generate_session(trains=200, now=time(12,0), start=time(6,0),
+                     end=time(22,0), delayed=0.3, transitions=0.1, seed=None):
+    """
+    Add a synthetic session to the database. Nothing is committed.
+
+    :param trains: number of trains
+    :param now: current time of the session, trains have real times up to it
+    :param start: earliest departure of a train
+    :param end: latest departure of a train
+    :param delayed: share of trains that run late
+    :param transitions: share of trains that turn into another train
+    :param seed: seed for the random number generator
+    :return: the list of created `Train` objects
+    """
+    rnd = random.Random(seed)
+    routes = get_routes()
+    now = time2seconds(now)
+    start = time2seconds(start)
+    end = time2seconds(end)
+
+    types = []
+    for name, category, stoptime, nr in TRAIN_TYPES:
+        types.append(TrainType(name=name, category=category,
+                               description=u'%s (generated)' % name))
+    db.session.add_all(types)
+    db.session.flush()
+
+    # a fallback, one entry per train type, and some location specific ones
+    db.session.add(MinimumStopTime(45))
+    for traintype, (_, _, stoptime, _) in zip(types, TRAIN_TYPES):
+        db.session.add(MinimumStopTime(stoptime, traintype))
+    for key in sorted(routes):
+        for loc in routes[key]:
+            if isinstance(loc, Station) and rnd.random() < 0.2:
+                db.session.add(MinimumStopTime(rnd.choice((40, 60, 90)),
+                                               loc=loc.code))
+                db.session.add(MinimumStopTime(rnd.choice((60, 90)),
+                    loc=loc.code, track=rnd.randint(1, 4)))
+
+    # create the trains first to get their ids
+    created = []
+    numbers = [nr for _, _, _, nr in TRAIN_TYPES]
+    for i in range(trains):
+        k = rnd.randrange(len(types))
+        created.append(Train(nr=numbers[k], type_obj=types[k],
+                             vmax=rnd.choice((80, 100, 120, 160))))
+        numbers[k] += 1
+    db.session.add_all(created)
+    db.session.flush()
+
+    # trains must not be on the same track at the session's current time
+    occupied = set()
+    entries = []
+    starts = {}
+    ends = {}
+    for train in created:
+        key = rnd.choice(sorted(routes))
+        route = routes[key]
+        tracks = TRACKS[key[1]]
+        # most trains run on most of the route
+        first = rnd.randint(0, len(route)//4)
+        last = rnd.randint(len(route) - len(route)//4, len(route))
+        if last - first >= 2:
+            route = route[first:last]
+
+        delay = rnd.randint(30, 900) if rnd.random() < delayed else 0
+        for attempt in range(20):
+            dep = rnd.randint(start, end)
+            timetable = make_timetable(rnd, train, route, tracks, dep,
+                                       delay, now)
+            elements = find_current_elements(timetable)
+            if not elements & occupied:
+                break
+        else:
+            # the train has not started yet, so it cannot be in the way
+            dep = rnd.randint(min(now + 60, end), end)
+            timetable = make_timetable(rnd, train, route, tracks, dep, 0, now)
+            elements = set()
+        occupied.update(elements)
+        entries.extend(timetable)
+
+        starts.setdefault((timetable[0]['loc'], timetable[0]['dep_plan']),
+                          train)
+        ends[train] = (timetable[-1]['loc'], timetable[-1]['arr_plan'])
+
+    insert_rows(TimetableEntry, entries)
+
+    # let some trains turn into a train starting where they end
+    by_loc = {}
+    for (loc, dep), train in sorted(starts.items()):
+        by_loc.setdefault(loc, []).append((dep, train))
+    for train in created:
+        if rnd.random() >= transitions:
+            continue
+        loc, arr = ends[train]
+        for dep, succ in by_loc.get(loc, ()):
+            if dep > arr and succ.transition_from_id is None \
+                    and succ is not train:
+                train.transition_to_id = succ.id
+                succ.transition_from_id = train.id
+                break
+    db.session.flush()
+
+    return created
+
+def make_timetable(rnd, train, route, tracks, dep, delay, now):
+    """
+    Create the timetable entries of `train` running along `route`.
+
+    :param tracks: tracks the train may use, see `TRACKS`
+    :param dep: departure time at the first location (in seconds)
+    :param delay: delay of the train against the plan (in seconds)
+    :param now: current time, earlier events get real times
+    :return: list of dicts, suitable for `insert_rows()`
+    """
+    entries = []
+    t = dep
+    for i, loc in enumerate(route):
+        stops = isinstance(loc, (Station, Stop))
+        track = rnd.choice(tracks) if stops else tracks[0]
+
+        arr = t if i > 0 else None
+        if i > 0 and i < len(route)-1 and stops and rnd.random() < 0.6:
+            t += rnd.choice((30, 60, 60, 120, 180))
+        dep = t if i < len(route)-1 else None
+
+        ridetime = None
+        if dep is not None:
+            nextloc = route[i+1]
+            ridetime = max(15, int(abs(nextloc.pos - loc.pos) * 1500))
+            t += ridetime
+
+        entry = dict(train_id=train.id, loc=loc.code,
+                     arr_plan=arr, dep_plan=dep, track_plan=track,
+                     min_ridetime=int(ridetime*0.8) if ridetime else None,
+                     sorttime=dep if dep is not None else arr,
+                     arr_want=arr, dep_want=dep, track_want=track)
+
+        # real times, for everything that has happened already
+        if arr is not None and arr + delay <= now:
+            entry['arr_real'] = arr + delay
+            entry['track_real'] = track
+        if dep is not None and dep + delay <= now:
+            entry['dep_real'] = dep + delay
+        entries.append(entry)
+
+        # the delay varies a little along the way
+        if delay:
+            delay = max(0, delay + rnd.randint(-10, 20))
+
+    for e in entries:
+        for key in ('arr_plan', 'dep_plan', 'sorttime', 'arr_want',
+                    'dep_want', 'arr_real', 'dep_real'):
+            if key in e:
+                e[key] = seconds2time(e[key]) if e[key] is not None else None
+    return entries
+
+def find_current_elements(timetable):
+    """
+    Get the elements (in the sense of `zwl.predict`) a train occupies at
+    the session's current time, i.e. the location where it last arrived
+    and, if it has departed from there, the line to the next location and
+    that location.
+    """
+    position = None
+    for i, e in enumerate(timetable):
+        if 'arr_real' in e or 'dep_real' in e:
+            position = i
+    if position is None or position == len(timetable)-1:
+        # not started yet, or already gone
+        return set()
+
+    current = timetable[position]
+    elements = {(current['loc'], current['track_plan'])}
+    if 'dep_real' in current:
+        next = timetable[position+1]
+        elements.add(('line', current['loc'], next['loc']))
+        elements.add((next['loc'], next['track_plan']))
+    return elements
+
+def insert_rows(model, rows):
+    """
+    Insert `rows` (dicts using the attribute names of `model`) by executing
+    one single-row INSERT statement for all of them (executemany), which is
+    a lot faster than adding objects to the session.
+    """
+    if not rows:
+        return
+    mapper = model.__mapper__
+    keys = set()
+    for row in rows:
+        keys.update(row)
+    columns = {k: mapper.get_property(k).columns[0].key for k in keys}
+    db.session.execute(model.__table__.insert(),
+        [{columns[k]: row.get(k) for k in keys} for row in rows])
+
+def clear_session():
+    """Delete all data `generate_session()` creates."""
+    for model in (TimetableEntry, MinimumStopTime, Train, TrainType):
+        db.session.query(model).delete()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fill the database with a synthetic session.')
+    parser.add_argument('-n', '--trains', type=int, default=200,
+                        help='number of trains')
+    parser.add_argument('--now', default='12:00',
+                        help='current time of the session (HH:MM)')
+    parser.add_argument('--delayed', type=float, default=0.3,
+                        help='share of delayed trains')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random number generator')
+    parser.add_argument('--database', default=None,
+                        help='database url, defaults to the configured one')
+    parser.add_argument('--clear', action='store_true',
+                        help='delete the existing session data first')
+    args = parser.parse_args()
+
+    if args.database is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    if app.config['SQLALCHEMY_DATABASE_URI'] is None:
+        parser.error('no database configured, use --database')
+
+    hours, minutes = map(int, args.now.split(':'))
+    db.create_all()
+    if args.clear:
+        clear_session()
+    created = generate_session(args.trains, now=time(hours, minutes),
+                               delayed=args.delayed, seed=args.seed)
+    db.session.commit()
+    print 'created %d trains' % len(created)
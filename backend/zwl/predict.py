@@ -9,30 +9,65 @@
     :license: GNU GPL 2.0 or later.
 """
 
-from collections import defaultdict, namedtuple
+from bisect import bisect_right
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date, time, timedelta
+from flask import json
+from heapq import heapify, heappush, heappop
+from itertools import count
 from math import ceil
+from multiprocessing import Pool
+from sqlalchemy import bindparam
+from sqlalchemy.orm.attributes import set_committed_value
+from threading import Lock
+from time import time as ttime
 from zwl import app, db
-from zwl.database import Train, TimetableEntry, MinimumStopTime
-from zwl.utils import timediff, timeadd, writable_namedtuple
+from zwl.database import Train, TimetableEntry, MinimumStopTime, \
+        MinimumStopTimeTable
+from zwl.lines import lineconfigs
+from zwl.utils import time2seconds, seconds2time, writable_namedtuple
 
 class Journey(object):
-    def __init__(self, train, now, timetable=None):
+    """
+    All times are handled as seconds (see `zwl.utils.time2seconds`), the
+    timetable entries are converted to `Stop` objects once on creation.
+
+    :param timetable: list of `TimetableEntry` objects
+    :param min_stoptimes: object providing a `lookup()` method like
+                          `MinimumStopTime.lookup()`, e.g. a shared
+                          `MinimumStopTimeTable`
+    :param plan: `JourneyPlan` of `timetable`, e.g. one kept from an earlier
+                 run. It is compiled if not given.
+    """
+    def __init__(self, train, now, timetable=None, min_stoptimes=None,
+                 plan=None):
         self.train = train
-        self.now = now
+        self.train_id = train.id
+        self.type_id = train.type_id
+        self.now = time2seconds(now)
+        self.min_stoptimes = min_stoptimes or MinimumStopTime
         if timetable is None:
             timetable = train.timetable_entries.order_by(TimetableEntry.sorttime.asc()).all()
         if not timetable:
             raise ValueError('Empty timetable for %r' % train)
-        self.timetable = timetable
-
-        # ensure we don't use old predictions, predictions are based on _want
-        # and _real data only. As we don't commit the transaction in between,
-        # the `None`s won't make it into the database.
-        for e in self.timetable:
-            e.arr_pred = e.dep_pred = None
 
-        self.position = self._find_current_position()
+        # `Stop`s don't carry old predictions, predictions are based on
+        # _want and _real data only. The old values are kept to be able to
+        # write only changed predictions, see `Manager.write_back`.
+        if plan is None:
+            plan = JourneyPlan(train, timetable)
+        self.plan = plan
+        self.timetable = [Stop.from_entry(e, p)
+                          for e, p in zip(timetable, plan.stops)]
+        self.original_predictions = [
+            (time2seconds(e.arr_pred), time2seconds(e.dep_pred))
+            for e in timetable]
+
+        self.position = find_current_position(self.timetable)
+        # set if the simulation was stopped before the journey ended, see
+        # `Manager.simulate`
+        self.incomplete = False
 
     def run(self):
         action = None
@@ -51,13 +86,16 @@ class Journey(object):
                     # has already happened, but still we need to report it
                     # for track occupation
                     action = Arrive(self, current.arr_real,
-                                Location(current.loc, current.track_real))
+                                Location(current.loc, current.track_real),
+                                [registry.intern((current.loc,
+                                                  current.track_real))])
                 else:
                     last = self.timetable[self.position-1]
                     current.arr_pred = self._earliest_arrival(last, current)
 
                     action = Arrive(self, current.arr_pred,
-                                    Location(current.loc, current.track_want))
+                                    current.plan.location,
+                                    current.plan.arrive_want)
 
                 if last_action is not None:
                     # this is guaranteed to be executed directly after
@@ -71,6 +109,7 @@ class Journey(object):
 
                 if current.dep_want is None:
                     # train ends here, we're done
+                    action.set_expected_release_time(action.time)
                     result = (yield EndJourney(self, action.time))
                     if not isinstance(result, Admitted):
                         raise ValueError('expected admission, got %r' % result)
@@ -78,29 +117,21 @@ class Journey(object):
 
             ### section two: handle ride to next location
             last_action = action
-            try:
-                next = self.timetable[self.position+1]
-            except IndexError:
+            plan = current.plan
+            if plan.ride is None:
                 if self.position == 0:
                     raise ValueError('Timetable of %r has less than two stops'
                                      % self.train)
                 break
 
-            try:
-                succ = self.timetable[self.position+2]
-                succ = Location(succ.loc, succ.track_want)
-            except IndexError:
-                succ = None
-
-            if current.dep_real:
+            if current.dep_real is not None:
                 # has already happened, but still we need to mark current
                 # track as occupied
                 if last_action is not None:
                     last_action.set_expected_release_time(current.dep_real)
-                action = Ride(self, current.dep_real,
-                              Location(current.loc, current.track_want),
-                              Location(next.loc, next.track_want),
-                              succ)
+                action = Ride(self, current.dep_real, plan.location,
+                              plan.next_location, plan.ride,
+                              plan.succ_location)
                 result = (yield action)
                 if not isinstance(result, Admitted):
                     raise RuntimeError('Not admitted for a ride that has '
@@ -113,10 +144,9 @@ class Journey(object):
                         last_action.set_expected_release_time(current.dep_pred)
 
                     #TODO do we need to consider current.track_real?
-                    action = Ride(self, current.dep_pred,
-                                  Location(current.loc, current.track_want),
-                                  Location(next.loc, next.track_want),
-                                  succ)
+                    action = Ride(self, current.dep_pred, plan.location,
+                                  plan.next_location, plan.ride,
+                                  plan.succ_location)
 
                     result = (yield action)
                     if isinstance(result, NotFree):
@@ -129,12 +159,25 @@ class Journey(object):
 
             self.position += 1
 
-    def _find_current_position(self):
-        """Find the latest timetable entry where the train has already been."""
-        for i, e in reversed(list(enumerate(self.timetable))):
-            if e.arr_real is not None or e.dep_real is not None:
-                return i
-        return 0
+    def element_ids(self):
+        """
+        Get the ids of all elements the train may occupy from its current
+        position on, like `find_journey_elements`.
+        """
+        ids = set()
+        intern = registry.intern
+        for stop in self.timetable[self.position:]:
+            ids.update(stop.plan.ride or stop.plan.arrive_want)
+            if stop.track_real is not None:
+                ids.add(intern((stop.loc, stop.track_real)))
+        return ids
+
+    def earliest_prediction(self):
+        """Return the earliest predicted time, None if there is none."""
+        return min([e.arr_pred for e in self.timetable
+                    if e.arr_pred is not None] +
+                   [e.dep_pred for e in self.timetable
+                    if e.dep_pred is not None] or [None])
 
     def _earliest_arrival(self, last, current):
         """
@@ -147,18 +190,18 @@ class Journey(object):
 
         # use real (not min) ride time if we are not delayed
         if last_dep <= last.dep_want:
-            min_ridetime = timediff(current.arr_want, last.dep_want)
+            min_ridetime = current.arr_want - last.dep_want
             #TODO special case: very small delay
 
         else:
-            if last.min_ridetime is not None:
-                min_ridetime = timedelta(seconds=last.min_ridetime)
+            if last.plan.min_ridetime is not None:
+                min_ridetime = last.plan.min_ridetime
             else:
-                ridetime = timediff(current.arr_want, last.dep_want).total_seconds()
+                ridetime = current.arr_want - last.dep_want
                 ratio = app.config['MINIMUM_TRAVEL_TIME_RATIO']
-                min_ridetime = timedelta(seconds=ceil(ridetime*ratio))
+                min_ridetime = int(ceil(ridetime*ratio))
 
-        return max(self.now, timeadd(last_dep, min_ridetime))
+        return max(self.now, last_dep + min_ridetime)
 
     def _earliest_departure(self, cur):
         """
@@ -175,54 +218,527 @@ class Journey(object):
         #TODO: if too early, only wait in stations
         arr = cur.arr_real if cur.arr_real is not None else cur.arr_pred
 
-        planned_stoptime = timediff(cur.dep_want, cur.arr_want)
-        if planned_stoptime.total_seconds() == 0:
+        planned_stoptime = cur.dep_want - cur.arr_want
+        if planned_stoptime == 0:
             min_stoptime = planned_stoptime
         else:
-            if cur.min_stoptime is not None:
-                min_stoptime = cur.min_stoptime
+            if cur.plan.min_stoptime is not None:
+                min_stoptime = cur.plan.min_stoptime
             else:
-                min_stoptime = MinimumStopTime.lookup(self.train, cur.loc,
-                        cur.track_real or cur.track_want)
-            min_stoptime = timedelta(seconds=min_stoptime)
+                min_stoptime = self.min_stoptimes.lookup(self.type_id,
+                        cur.loc, cur.track_real or cur.track_want)
 
             min_stoptime = min(min_stoptime, planned_stoptime)
 
-        return max(self.now, cur.dep_want, timeadd(arr, min_stoptime))
+        return max(self.now, cur.dep_want, arr + min_stoptime)
+
+    def __getstate__(self):
+        # other processes (see `Manager.simulate`) get the train's
+        # representation only, not the database object
+        state = self.__dict__.copy()
+        state['train'] = repr(self.train)
+        return state
+
+    def __repr__(self):
+        return '<Journey of %s>' % (self.train,)
+
+
+class Stop(object):
+    """
+    The data of a `TimetableEntry` the prediction is based on, with all
+    times converted to seconds. `entry` is the original object, `plan` the
+    corresponding `StopPlan` holding the data that doesn't depend on time.
+    """
+    __slots__ = ('entry', 'plan', 'track_real',
+                 'arr_want', 'arr_real', 'arr_pred',
+                 'dep_want', 'dep_real', 'dep_pred')
+
+    def __init__(self, entry, plan, track_real,
+                 arr_want, arr_real, dep_want, dep_real):
+        self.entry = entry
+        self.plan = plan
+        self.track_real = track_real
+        self.arr_want = arr_want
+        self.arr_real = arr_real
+        self.dep_want = dep_want
+        self.dep_real = dep_real
+        self.arr_pred = self.dep_pred = None
+
+    @classmethod
+    def from_entry(cls, e, plan):
+        return cls(e, plan, e.track_real,
+                   time2seconds(e.arr_want), time2seconds(e.arr_real),
+                   time2seconds(e.dep_want), time2seconds(e.dep_real))
+
+    @property
+    def loc(self):
+        return self.plan.loc
+
+    @property
+    def track_want(self):
+        return self.plan.track_want
+
+    def __getstate__(self):
+        # the database object is not passed to other processes
+        return tuple(getattr(self, a) for a in self.__slots__[1:])
+
+    def __setstate__(self, state):
+        self.entry = None
+        for a, value in zip(self.__slots__[1:], state):
+            setattr(self, a, value)
+
+    def __repr__(self):
+        return '<Stop %s[%s]>' % (self.loc, self.track_want)
+
+
+class JourneyPlan(object):
+    """
+    The part of a train's journey that doesn't depend on time: one
+    `StopPlan` per timetable entry, with the ids of the elements needed
+    (see `ElementRegistry`) already looked up.
+
+    A plan stays valid as long as the data in `key` (see `plan_key`) is
+    unchanged, so `Predictor` compiles it only once per train and reuses it
+    in later runs. Only `Journey.run` has to be evaluated again.
+    """
+    __slots__ = ('key', 'stops')
+
+    def __init__(self, train, timetable):
+        self.key = plan_key(train, timetable)
+        intern = registry.intern
+        self.stops = stops = [StopPlan(e.loc, e.track_want, e.min_ridetime,
+                                       e.min_stoptime) for e in timetable]
+        for i, stop in enumerate(stops):
+            stop.location = Location(stop.loc, stop.track_want)
+            want = intern(stop.location)
+            stop.arrive_want = [want]
+            if i+1 < len(stops):
+                next = stops[i+1]
+                stop.next_location = Location(next.loc, next.track_want)
+                stop.ride = [want, intern(('line', stop.loc, next.loc)),
+                             intern(stop.next_location)]
+            if i+2 < len(stops):
+                succ = stops[i+2]
+                stop.succ_location = Location(succ.loc, succ.track_want)
+
+    def __getstate__(self):
+        return self.key, self.stops
+
+    def __setstate__(self, state):
+        self.key, self.stops = state
 
     def __repr__(self):
-        return '<Journey of %r>' % self.train
+        return '<JourneyPlan (%d stops)>' % len(self.stops)
+
+
+class StopPlan(object):
+    """
+    The static data of a `Stop`: the `Location` objects and element ids of
+    arriving here (on the wanted track) and of riding to the next stop
+    (None at the last stop), as well as the minimum times.
+    """
+    __slots__ = ('loc', 'track_want', 'min_ridetime', 'min_stoptime',
+                 'location', 'arrive_want', 'next_location', 'ride',
+                 'succ_location')
+
+    def __init__(self, loc, track_want, min_ridetime, min_stoptime):
+        self.loc = loc
+        self.track_want = track_want
+        self.min_ridetime = min_ridetime
+        self.min_stoptime = min_stoptime
+        self.location = self.arrive_want = None
+        self.next_location = self.ride = self.succ_location = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, a) for a in self.__slots__)
+
+    def __setstate__(self, state):
+        for a, value in zip(self.__slots__, state):
+            setattr(self, a, value)
+
+    def __repr__(self):
+        return '<StopPlan %s[%s]>' % (self.loc, self.track_want)
 
 
 class Manager(object):
-    def __init__(self, journeys, now):
+    """
+    :param processes: number of processes to use for the simulation, see
+                      `simulate()`. Defaults to config.PREDICTION_PROCESSES.
+    :param stats: `PredictionStats` object to collect statistics in, if any
+    :param time_budget: maximum duration of `simulate()` in seconds.
+                        Defaults to config.PREDICTION_TIME_BUDGET.
+    :param step_budget: maximum number of actions `simulate()` processes
+                        (per process). Defaults to
+                        config.PREDICTION_STEP_BUDGET.
+
+    Elements are referred to by their ids in `registry`. Per-element state
+    is kept in lists indexed by these ids.
+    """
+    def __init__(self, journeys, now, processes=None, stats=None,
+                 time_budget=None, step_budget=None):
         self.journeys = journeys
         self.now = now
-        self.elements = defaultdict(lambda: None)
+        if processes is None:
+            processes = app.config['PREDICTION_PROCESSES']
+        self.processes = processes
+        self.stats = stats
+        if time_budget is None:
+            time_budget = app.config['PREDICTION_TIME_BUDGET']
+        self.time_budget = time_budget
+        if step_budget is None:
+            step_budget = app.config['PREDICTION_STEP_BUDGET']
+        self.step_budget = step_budget
+        # journeys whose simulation was stopped because the budget ran out
+        self.incomplete = []
+        # deadlocks found, each a list of the journeys involved, the first
+        # one being the journey that was stopped
+        self.deadlocks = []
+        # current occupation of each element (None if free)
+        self.elements = []
+        # all occupations, past and present: {element: Timeline}
+        self.timelines = defaultdict(Timeline)
+        # reverse index of `elements`: {journey: set of elements}
+        self.held = defaultdict(set)
+        # blocked journeys, see `simulate()`: list of QueueEntry lists
+        self.waiting = []
+        # the wait-for graph: {journey: element it waits for}
+        self.waiting_for = {}
+        # elements released since the last wake-up that journeys wait for
+        self.released = []
+        # time of the action being processed (in seconds)
+        self.time = None
+        # number of timetable entries updated by `write_back`
+        self.written = None
 
     def run(self):
-        queue = []
+        """
+        Calculate the predictions and store them in the database.
+
+        :return: number of timetable entries updated
+        """
+        with phase(self.stats, 'simulate'):
+            self.simulate()
+        with phase(self.stats, 'write_back'):
+            return self.write_back()
+
+    def simulate(self):
+        """
+        Calculate the predictions.
+
+        The journeys are split into groups that don't share any elements
+        (see `find_components`). If more than one process is to be used,
+        the groups are simulated in a process pool. Journeys forming a group
+        of their own can't be blocked, so their actions are admitted without
+        looking at the elements (see `Action.admit`), but still in time
+        order along with all others, as described below.
+
+        A journey whose action is not admitted is put aside, waiting for the
+        element blocking it. Only when that element is released, the journey
+        is sent the `NotFree` response, so it will try again one second
+        after the release.
+
+        If the journey holding that element waits itself, and so on, until
+        a journey holding an element the first one holds, they are
+        deadlocked. The journey closing the cycle is stopped, which releases
+        its elements, and the deadlock is reported in `self.deadlocks`.
+
+        If the time or step budget runs out, the simulation is stopped.
+        Actions are processed in time order, so the predictions computed so
+        far are the earliest ones. Journeys that haven't ended are marked
+        `incomplete` and listed in `self.incomplete`.
+        """
+        stats = self.stats
+        if stats is not None:
+            stats.journeys += len(self.journeys)
+
+        components = find_components(self.journeys)
+        if self.processes > 1 and len(components) > 1:
+            self._simulate_parallel(components)
+            return
+        alone = set(c[0] for c in components if len(c) == 1)
+
+        deadline = None
+        if self.time_budget is not None:
+            deadline = ttime() + self.time_budget
+        step_budget = self.step_budget
+        def _exhausted(steps):
+            if step_budget is not None and steps >= step_budget:
+                return True
+            # looking at the clock every 256 steps is often enough
+            return deadline is not None and not steps & 0xff \
+                and ttime() > deadline
+
+        # all elements of the journeys are interned by now
+        grow = len(registry) - len(self.elements)
+        self.elements.extend([None] * grow)
+        self.waiting.extend([None] * grow)
+
+        entries = []
         for j in self.journeys:
             runner = j.run()
 
             next_action = runner.next()
 
-            queue.append(QueueEntry(j, runner, next_action))
+            entries.append(QueueEntry(j, runner, next_action))
+        queue = ActionQueue(entries)
 
+        steps = 0
         while queue:
-            # find the journey with the earliest action
-            queue.sort(key=lambda qe: qe.next_action.time)
-            entry = queue[0]
+            if _exhausted(steps):
+                break
+            steps += 1
+
+            # process the journey with the earliest action
+            entry = queue.pop()
             journey, runner, action = entry
+            self.time = action.time
 
-            response = action.allocate(self)
+            if journey in alone:
+                response = action.admit(self)
+            else:
+                response = action.allocate(self)
+            if stats is not None:
+                stats.actions += 1
+                stats.journey_actions[journey.train_id] += 1
+
+            if isinstance(response, NotFree):
+                cycle = self._find_cycle(journey, response.element)
+                if cycle is None:
+                    self._wait(entry, response.element)
+                else:
+                    self._resolve_deadlock(entry, cycle)
+            else:
+                self._advance(queue, entry, response)
 
-            try:
-                entry.next_action = runner.send(response)
-            except StopIteration:
-                #TODO free occupations
-                queue.pop(0)
+            while self.released:
+                self._wake(queue)
+
+        # out of budget. Without cycles in the wait-for graph, journeys
+        # only wait for journeys that are still in the queue.
+        while queue:
+            self._stop(queue.pop())
+        for e, entries in enumerate(self.waiting):
+            if entries is None:
+                continue
+            self.waiting[e] = None
+            for entry in entries:
+                self._stop(entry)
+        self.waiting_for.clear()
+        del self.released[:]
+
+        if self.incomplete:
+            app.logger.warning('prediction: out of budget, %d journeys '
+                'incomplete', len(self.incomplete))
+        if stats is not None:
+            stats.incomplete.extend(j.train_id for j in self.incomplete)
+
+    def _stop(self, entry):
+        """Stop the simulation of the journey of `entry` before its end."""
+        entry.runner.close()
+        self.release(entry.journey)
+        entry.journey.incomplete = True
+        self.incomplete.append(entry.journey)
+
+    def _advance(self, queue, entry, response):
+        """
+        Send `response` to the journey of `entry` and re-insert it into
+        `queue` using the time of its next action.
+        """
+        try:
+            entry.next_action = entry.runner.send(response)
+        except StopIteration:
+            self.release(entry.journey)
+            return
+        queue.push(entry)
+
+    def _wait(self, entry, e):
+        """Put `entry` aside until element `e` is released."""
+        waiting = self.waiting[e]
+        if waiting is None:
+            self.waiting[e] = [entry]
+        else:
+            waiting.append(entry)
+        self.waiting_for[entry.journey] = e
+
+    def _wake(self, queue):
+        """Continue the journeys waiting for the elements just released."""
+        released, self.released = self.released, []
+        for e in released:
+            entries = self.waiting[e]
+            self.waiting[e] = None
+            for entry in entries or ():
+                del self.waiting_for[entry.journey]
+                self._advance(queue, entry, NotFree(self.time + 1))
+
+    def _find_cycle(self, journey, e):
+        """
+        Check whether `journey` waiting for element `e` would close a cycle
+        in the wait-for graph, i.e. whether the journey holding `e` waits
+        (directly or through other journeys) for an element `journey` holds.
+
+        As cycles are detected as soon as they form, every other path in the
+        graph ends at a journey that doesn't wait.
+
+        :return: list of the journeys forming the cycle, starting with
+                 `journey`, or None
+        """
+        cycle = [journey]
+        while True:
+            holder = self.elements[e].journey
+            if holder is journey:
+                return cycle
+            cycle.append(holder)
+            e = self.waiting_for.get(holder)
+            if e is None:
+                return None
+
+    def _resolve_deadlock(self, entry, cycle):
+        """
+        Stop the simulation of the journey of `entry`, which would close
+        `cycle`, so the other journeys can continue.
+        """
+        app.logger.warning('prediction: deadlock of %s at %s, stopping %r',
+            ', '.join(repr(j) for j in cycle), seconds2time(self.time),
+            entry.journey)
+        entry.runner.close()
+        self.release(entry.journey)
+        self.deadlocks.append(cycle)
+        if self.stats is not None:
+            self.stats.deadlocks.append([j.train_id for j in cycle])
+
+    def _simulate_parallel(self, components):
+        # other processes can't access the database
+        for j in self.journeys:
+            if isinstance(j.min_stoptimes, MinimumStopTimeTable) \
+                    and j.min_stoptimes.rows is None:
+                j.min_stoptimes.load()
+
+        # all processes share the deadline
+        deadline = None
+        if self.time_budget is not None:
+            deadline = ttime() + self.time_budget
+
+        pool, known = get_pool(self.processes)
+        # elements interned since the pool was created
+        added = registry.elements[known:]
+        results = pool.map(_simulate_component,
+            [(c, self.now, self.stats is not None,
+              deadline, self.step_budget, known, added)
+             for c in components])
+
+        for component, (predictions, timelines, stats, incomplete,
+                deadlocks) in zip(components, results):
+            if stats is not None:
+                self.stats.merge(stats)
+            for i in incomplete:
+                component[i].incomplete = True
+                self.incomplete.append(component[i])
+            for cycle in deadlocks:
+                self.deadlocks.append([component[i] for i in cycle])
+            for element, occupancies in timelines.items():
+                timeline = self.timelines[registry.intern(element)]
+                for i, start, end in occupancies:
+                    timeline.add(Occupancy(component[i], start, end, None))
+            for j, stops in zip(component, predictions):
+                for stop, (arr_pred, dep_pred) in zip(j.timetable, stops):
+                    stop.arr_pred = arr_pred
+                    stop.dep_pred = dep_pred
+
+    def write_back(self):
+        """
+        Write the predictions to the database.
+
+        Only predictions that differ from the ones the journeys were created
+        with are written, using a single (executemany) UPDATE statement. The
+        timetable entry objects are updated as well, but marked as unchanged,
+        so the session won't flush them again.
+
+        Incomplete journeys keep their old predictions where no new ones
+        have been computed.
+
+        :return: number of timetable entries updated
+        """
+        changes = []
+        for j in self.journeys:
+            for stop, original in zip(j.timetable, j.original_predictions):
+                predictions = (stop.arr_pred, stop.dep_pred)
+                if j.incomplete:
+                    predictions = tuple(old if new is None else new
+                        for new, old in zip(predictions, original))
+                if predictions == original:
+                    continue
+                arr_pred = seconds2time(predictions[0])
+                dep_pred = seconds2time(predictions[1])
+                changes.append({'_id': stop.entry.id, '_arr_pred': arr_pred,
+                                '_dep_pred': dep_pred})
+                set_committed_value(stop.entry, 'arr_pred', arr_pred)
+                set_committed_value(stop.entry, 'dep_pred', dep_pred)
+
+        if changes:
+            db.session.execute(_update_predictions, changes)
+
+        self.written = len(changes)
+        return self.written
+
+    def occupy(self, journey, elements):
+        """
+        Mark `elements` as occupied by `journey`. All other elements held by
+        `journey` are freed.
+        """
+        held = self.held[journey]
+        for e in held.difference(elements):
+            self._free(e)
+
+        for e in elements:
+            if e in held:
+                # still occupied, but the release time is to be set anew
+                self.elements[e].expected_release_time = None
+                continue
+            occupancy = Occupancy(journey, self.time, None, None)
+            self.elements[e] = occupancy
+            self.timelines[e].add(occupancy)
+        self.held[journey] = set(elements)
+
+    def release(self, journey):
+        """Free all elements held by `journey`."""
+        for e in self.held.pop(journey, ()):
+            self._free(e)
+
+    def _free(self, e):
+        self.elements[e].end = self.time
+        self.elements[e] = None
+        if self.waiting[e] is not None:
+            self.released.append(e)
+
+    def occupied(self):
+        """
+        Get the elements occupied currently.
 
+        :return: dict of the form {element: Occupancy}, with elements given
+                 as tuples (see `ElementRegistry`)
+        """
+        return {registry.elements[e]: o
+                for e, o in enumerate(self.elements) if o is not None}
+
+    def timeline(self, element):
+        """
+        Get the `Timeline` of `element`, given as tuple (see
+        `ElementRegistry`).
+        """
+        id = registry.ids.get(element)
+        if id is None or id not in self.timelines:
+            return Timeline()
+        return self.timelines[id]
+
+    def free_after(self, element, time, duration=0):
+        """
+        Find the earliest time (in seconds) not before `time` from which on
+        `element` (given as tuple) is free for at least `duration` seconds,
+        according to the last simulation.
+
+        :return: seconds, or None if the element is not freed anymore
+        """
+        return self.timeline(element).free_after(time, duration)
 
     @classmethod
     def from_timestamp(cls, starttime):
@@ -232,24 +748,834 @@ class Manager(object):
         All trains running config.PREDICTION_INTERVAL seconds from that start
         time are used.
         """
-        d = timedelta(seconds=app.config['PREDICTION_INTERVAL'])
-        endtime = (datetime.combine(date(1,1,1), starttime) + d).time()
-        endtime = max(endtime, time(23,59,59)) #TODO after-midnight support
+        return cls.from_trains(get_trains_within_horizon(starttime), starttime)
+
+    @classmethod
+    def from_trains(cls, trains, now, min_stoptimes=None, processes=None):
+        if min_stoptimes is None:
+            min_stoptimes = MinimumStopTimeTable()
+        timetables = get_timetables(trains)
+        return cls([Journey(t, now, timetables[t.id], min_stoptimes)
+                    for t in trains], now, processes)
+
+    def __repr__(self):
+        return '<Manager time=%s (%d journeys)>' % \
+            (seconds2time(self.time), len(self.journeys))
+
+
+class Predictor(object):
+    """
+    Prediction engine keeping its state between runs.
+
+    On each run, only those trains are simulated whose timetable data changed
+    since the last run (or whose predictions depend on the current time),
+    together with all trains they share infrastructure elements with
+    (transitively). The predictions of all other trains are left untouched.
+
+    The prediction horizon is split: trains running within
+    config.PREDICTION_NEAR_HORIZON seconds are considered on every run, the
+    others (up to config.PREDICTION_INTERVAL) only every
+    config.PREDICTION_FAR_REFRESH_INTERVAL seconds (simulation time). In
+    between, their state and predictions are kept as they are, unless they
+    share elements with trains simulated again.
+
+    Changes of the minimum stop times or of the configuration are not
+    detected, call `invalidate()` after such changes.
+    """
+    def __init__(self):
+        self.now = None
+        # time of the last run covering the whole horizon
+        self.far_refreshed = None
+        # state of the last run, of the form {train id: TrainState}
+        self.trains = {}
+        # compiled journeys, of the form {train id: JourneyPlan}
+        self.plans = {}
+        self.min_stoptimes = MinimumStopTimeTable()
+        self._lock = Lock()
+
+    def invalidate(self):
+        """Forget all state, so the next run simulates all trains."""
+        with self._lock:
+            self.now = None
+            self.far_refreshed = None
+            self.trains = {}
+            self.plans = {}
+            self.min_stoptimes.invalidate()
+
+    def run(self, now, trains=None):
+        """
+        Update the predictions for the given `trains`.
 
-        q = db.session.query(TimetableEntry.train_id) \
-            .filter(TimetableEntry.sorttime.between(starttime, endtime))
+        :param trains: list of `Train` objects, defaults to the trains
+                       within the near or the whole prediction horizon, see
+                       `Predictor`.
+        :return: the `Manager` used for the simulation. Its `journeys` are
+                 the trains that were simulated again.
+        """
+        with self._lock:
+            return self._run(now, trains)
+
+    def _run(self, now, trains):
+        stats = PredictionStats() if app.config['PREDICTION_STATS'] else None
+
+        with phase(stats, 'load'):
+            full = True
+            if trains is None:
+                full = self._far_refresh_due(now)
+                if full:
+                    trains = get_trains_within_horizon(now)
+                else:
+                    trains = get_trains_within_horizon(now,
+                        app.config['PREDICTION_NEAR_HORIZON'])
+            timetables = get_timetables(trains)
+
+            affected, states = self._find_affected_trains(
+                trains, timetables, now, full)
+            if not full:
+                far = self._find_far_trains(states, affected)
+                if far:
+                    far = Train.query.filter(Train.id.in_(far)).all()
+                    timetables.update(get_timetables(far))
+                    for t in far:
+                        states[t.id] = TrainState(
+                            fingerprint(t, timetables[t.id]),
+                            find_journey_elements(timetables[t.id]), None)
+                        affected.add(t.id)
+                    trains = trains + far
+
+            # plans of trains that are gone are dropped. Trains that are not
+            # affected have an unchanged fingerprint, so their plans are
+            # still valid.
+            plans = {}
+            journeys = []
+            for t in trains:
+                if t.id in affected:
+                    plans[t.id] = plan = get_plan(self.plans, t,
+                                                  timetables[t.id])
+                    journeys.append(Journey(t, now, timetables[t.id],
+                                            self.min_stoptimes, plan))
+                elif t.id in self.plans:
+                    plans[t.id] = self.plans[t.id]
+
+        manager = Manager(journeys, now, stats=stats)
+        manager.run()
+
+        for j in manager.journeys:
+            states[j.train_id].earliest_prediction = j.earliest_prediction()
+        for j in manager.incomplete:
+            # to be simulated again in the next run
+            states[j.train_id].fingerprint = None
+
+        if full:
+            self.far_refreshed = now
+        else:
+            # trains beyond the near horizon are kept until the next full run
+            for tid, old in self.trains.items():
+                if tid not in states:
+                    states[tid] = old
+                    if tid in self.plans:
+                        plans[tid] = self.plans[tid]
+        self.now = now
+        self.trains = states
+        self.plans = plans
 
-        trains = Train.query.filter(Train.id.in_(q)).all()
+        if stats is not None:
+            stats.trains = len(trains)
+            stats.horizon = 'full' if full else 'near'
+            if app.config['PREDICTION_STATS_LOG']:
+                app.logger.info('prediction stats: %s',
+                                json.dumps(stats.as_dict()))
 
-        return cls.from_trains(trains, starttime)
+        return manager
+
+    def _far_refresh_due(self, now):
+        """
+        Check whether the run at `now` has to cover the whole prediction
+        horizon instead of the near horizon only.
+        """
+        if app.config['PREDICTION_NEAR_HORIZON'] is None \
+                or self.far_refreshed is None:
+            return True
+        elapsed = time2seconds(now) - time2seconds(self.far_refreshed)
+        # the time may have been set back
+        return not 0 <= elapsed < app.config['PREDICTION_FAR_REFRESH_INTERVAL']
+
+    def _find_affected_trains(self, trains, timetables, now, full=True):
+        """
+        Compare the trains' data with the last run's.
+
+        If not `full`, `trains` are those within the near horizon only, and
+        trains of the last run missing from it are not considered gone.
+
+        :return: tuple `(affected, states)`, with `affected` being the set of
+                 ids of trains to be simulated again and `states` being the
+                 new state of the form {train id: TrainState}
+        """
+        states = {}
+        dirty = set()
+        dirty_elements = set()
+        for t in trains:
+            timetable = timetables[t.id]
+            state = TrainState(
+                fingerprint(t, timetable),
+                find_journey_elements(timetable), None)
+            states[t.id] = state
+
+            old = self.trains.get(t.id)
+            if old is not None and old.fingerprint == state.fingerprint \
+                    and not self._depends_on_now(old, now):
+                state.earliest_prediction = old.earliest_prediction
+                continue
+
+            dirty.add(t.id)
+            dirty_elements.update(state.elements)
+            if old is not None:
+                dirty_elements.update(old.elements)
+
+        # trains that are gone don't block other trains anymore
+        if full:
+            for tid, old in self.trains.items():
+                if tid not in states:
+                    dirty_elements.update(old.elements)
+
+        return find_affected_trains(states, dirty, dirty_elements), states
+
+    def _find_far_trains(self, states, affected):
+        """
+        Find the trains beyond the near horizon (known from the last run)
+        sharing elements with the `affected` trains of a near run, directly
+        or transitively. They are simulated along with them, as they may
+        block them later on, so a near run predicts the same as a full one.
+
+        :param states: the new states of the trains within the near horizon
+        :return: set of train ids
+        """
+        combined = dict(self.trains)
+        combined.update(states)
+        return find_affected_trains(combined, affected, ()) - set(states)
+
+    def _depends_on_now(self, state, now):
+        """
+        Check whether the predictions of a train can be different because
+        the current time changed from `self.now` to `now`.
+        """
+        if now == self.now or state.earliest_prediction is None:
+            return False
+        # predicted times are never earlier than `now`. If the time moved
+        # forward, predictions before `now` will change; if it moved
+        # backward, predictions that have been equal to `self.now` may.
+        return state.earliest_prediction <= \
+            time2seconds(max(self.now, now))
 
-    @classmethod
-    def from_trains(cls, trains, now):
-        return cls([Journey(t, now) for t in trains], now)
+
+class Scenario(object):
+    """
+    Predictions for a hypothetical variant of the timetable data ("what if
+    train 2342 departs five minutes late?"), computed without touching the
+    database.
+
+    The scenario starts from the state of the last run of `predictor`,
+    which is copied, not changed. Only the trains affected by the overrides
+    (in the sense of `Predictor`) are simulated, at the time of that run,
+    and compared with the predictions stored in the database. Several
+    scenarios can be evaluated at the same time.
+
+    :param overrides: dict of the form {timetable entry id: {attribute:
+                      value}}, with the attributes listed in `FIELDS`
+    """
+    FIELDS = ('arr_want', 'dep_want', 'arr_real', 'dep_real',
+              'track_want', 'track_real', 'min_ridetime', 'min_stoptime')
+
+    def __init__(self, predictor, overrides):
+        for fields in overrides.values():
+            for name in fields:
+                if name not in self.FIELDS:
+                    raise ValueError('%r cannot be overridden' % name)
+        self.overrides = overrides
+
+        with predictor._lock:
+            if predictor.now is None:
+                raise ValueError('%r has not run yet' % predictor)
+            self.now = predictor.now
+            # the dicts are replaced, not modified, by later runs
+            self.states = dict(predictor.trains)
+            self.plans = predictor.plans
+            self.min_stoptimes = predictor.min_stoptimes
+        self.manager = None
+
+    def run(self):
+        """
+        Simulate the affected trains.
+
+        :return: the predictions that differ from the stored ones, see
+                 `changes()`
+        :raise ValueError: if the overrides are invalid, see `_apply()`
+        """
+        entries = TimetableEntry.query \
+            .filter(TimetableEntry.id.in_(self.overrides)).all()
+        if len(entries) != len(self.overrides):
+            raise ValueError('unknown timetable entries in %r'
+                             % self.overrides.keys())
+
+        changed = set(e.train_id for e in entries)
+        trains = {t.id: t for t in
+                  Train.query.filter(Train.id.in_(changed)).all()}
+        timetables = self._apply(get_timetables(trains.values()))
+
+        elements = set()
+        for tid, train in trains.items():
+            state = TrainState(fingerprint(train, timetables[tid]),
+                               find_journey_elements(timetables[tid]), None)
+            if tid in self.states:
+                elements.update(self.states[tid].elements)
+            elements.update(state.elements)
+            self.states[tid] = state
+
+        others = find_affected_trains(self.states, changed, elements) \
+            - changed
+        if others:
+            for t in Train.query.filter(Train.id.in_(others)).all():
+                trains[t.id] = t
+            timetables.update(get_timetables(
+                [trains[tid] for tid in others]))
+
+        journeys = []
+        for tid in sorted(trains):
+            plan = get_plan(self.plans, trains[tid], timetables[tid])
+            journeys.append(Journey(trains[tid], self.now, timetables[tid],
+                                    self.min_stoptimes, plan))
+        self.manager = Manager(journeys, self.now, processes=1)
+        self.manager.simulate()
+        return self.changes()
+
+    def _apply(self, timetables):
+        """
+        Replace the overridden entries in `timetables`.
+
+        :raise ValueError: if an override removes a value the simulation
+                           needs: the arrival at every stop but the first,
+                           the departure at every stop but the last, or the
+                           track of a stop that has one
+        """
+        for timetable in timetables.values():
+            last = len(timetable) - 1
+            for i, e in enumerate(timetable):
+                if e.id not in self.overrides:
+                    continue
+                o = timetable[i] = OverriddenEntry(e, self.overrides[e.id])
+                if (i > 0 and o.arr_want is None) \
+                        or (i < last and o.dep_want is None) \
+                        or (o.track_want is None and e.track_want is not None):
+                    raise ValueError('%r lacks a time or track' % o)
+        return timetables
+
+    def changes(self):
+        """
+        :return: list of dicts with the keys `train_id`, `entry_id`, `loc`,
+                 `arr_pred` and `dep_pred`, the latter being tuples `(stored
+                 prediction, scenario's prediction)`
+        """
+        result = []
+        for j in self.manager.journeys:
+            for stop, (arr, dep) in zip(j.timetable, j.original_predictions):
+                if (stop.arr_pred, stop.dep_pred) == (arr, dep):
+                    continue
+                result.append(dict(
+                    train_id=j.train_id,
+                    entry_id=stop.entry.id,
+                    loc=stop.loc,
+                    arr_pred=(seconds2time(arr), seconds2time(stop.arr_pred)),
+                    dep_pred=(seconds2time(dep), seconds2time(stop.dep_pred)),
+                ))
+        return result
 
     def __repr__(self):
-        return '<Manager time=%s (%d journeys)>' % \
-            (self.time.strftime('%T'), len(self.journeys))
+        return '<Scenario at %s (%d entries overridden)>' % (self.now,
+            len(self.overrides))
+
+
+class OverriddenEntry(object):
+    """
+    A `TimetableEntry` with some of its attributes replaced, leaving the
+    entry itself untouched.
+    """
+    def __init__(self, entry, overrides):
+        self._entry = entry
+        self._overrides = overrides
+
+    def __getattr__(self, name):
+        try:
+            return self._overrides[name]
+        except KeyError:
+            return getattr(self._entry, name)
+
+    def __repr__(self):
+        return '<OverriddenEntry %r %r>' % (self._entry, self._overrides)
+
+
+class PredictionStats(object):
+    """
+    Counters and timings collected during a prediction run.
+    """
+    def __init__(self):
+        # duration of the phases of the run (load, simulate, write_back)
+        self.timings = OrderedDict()
+        # number of trains within the horizon, and of those simulated
+        self.trains = 0
+        self.journeys = 0
+        # part of the prediction horizon covered ('near' or 'full')
+        self.horizon = None
+        # ids of the trains not simulated completely, see `Manager.simulate`
+        self.incomplete = []
+        # deadlocks, as lists of the ids of the trains involved, see
+        # `Manager.simulate`
+        self.deadlocks = []
+        # number of actions processed, in total and per train id
+        self.actions = 0
+        self.journey_actions = defaultdict(int)
+        # number of `NotFree` responses, in total and per element causing
+        # them (one response may be caused by several elements)
+        self.not_free_responses = 0
+        self.not_free = defaultdict(int)
+
+    def merge(self, other):
+        """Add the counters of `other`, e.g. collected in another process."""
+        self.trains += other.trains
+        self.journeys += other.journeys
+        self.actions += other.actions
+        self.not_free_responses += other.not_free_responses
+        self.incomplete.extend(other.incomplete)
+        self.deadlocks.extend(other.deadlocks)
+        for tid, n in other.journey_actions.items():
+            self.journey_actions[tid] += n
+        for e, n in other.not_free.items():
+            self.not_free[e] += n
+
+    def as_dict(self, top=10):
+        """
+        Summarize the statistics in a JSON serializable form, listing the
+        `top` elements and journeys only.
+        """
+        def _top(d):
+            return sorted(d.items(), key=lambda (k, n): (-n, k))[:top]
+        return dict(
+            timings=self.timings,
+            trains=self.trains,
+            journeys=self.journeys,
+            horizon=self.horizon,
+            incomplete=sorted(self.incomplete),
+            deadlocks=self.deadlocks,
+            actions=self.actions,
+            not_free=self.not_free_responses,
+            not_free_elements=[dict(element=format_element(e), count=n)
+                               for e, n in _top(self.not_free)],
+            longest_journeys=[dict(train_id=tid, actions=n)
+                              for tid, n in _top(self.journey_actions)],
+        )
+
+@contextmanager
+def phase(stats, name):
+    """
+    Add the duration of the `with` block to the timing of phase `name` in
+    `stats`. Does nothing if `stats` is None.
+    """
+    if stats is None:
+        yield
+        return
+
+    start = ttime()
+    try:
+        yield
+    finally:
+        stats.timings[name] = stats.timings.get(name, 0) + ttime() - start
+
+def format_element(e):
+    """Get a human-readable name of an element."""
+    if e[0] == 'line':
+        return '%s_%s' % e[1:]
+    return '%s[%s]' % e
+
+
+class ElementRegistry(object):
+    """
+    Maps elements to dense integer ids, so the manager can keep per-element
+    state in lists and actions can carry precomputed lists of ids.
+
+    Elements are tuples, either `(location, track)` or
+    `('line', start location, end location)`. Ids are never reused or
+    removed, so ids of one registry are valid in all processes forked from
+    the process that created them. Pool processes are kept up to date using
+    `sync()`.
+    """
+    def __init__(self):
+        # {element: id} and the reverse mapping, a list indexed by id
+        self.ids = {}
+        self.elements = []
+        self._lock = Lock()
+
+    def intern(self, element):
+        """Get the id of `element`, adding it if it's not known yet."""
+        try:
+            return self.ids[element]
+        except KeyError:
+            pass
+        with self._lock:
+            if element not in self.ids:
+                self.ids[element] = len(self.elements)
+                self.elements.append(element)
+            return self.ids[element]
+
+    def add_lineconfigs(self, lineconfigs):
+        """
+        Add the elements of the given lineconfigs: all locations (without
+        track) and the lines between neighbouring locations, in both
+        directions.
+        """
+        for line in lineconfigs:
+            codes = line.locationcodes
+            for code in codes:
+                self.intern((code, None))
+            for a, b in zip(codes, codes[1:]):
+                if a != b:
+                    self.intern(('line', a, b))
+                    self.intern(('line', b, a))
+
+    def sync(self, known, added):
+        """
+        Bring the registry of a pool process (see `get_pool`) up to date:
+        forget the elements interned here after the first `known` ones and
+        add the elements the calling process has `added` since then.
+        """
+        with self._lock:
+            for element in self.elements[known:]:
+                del self.ids[element]
+            del self.elements[known:]
+            for element in added:
+                self.ids[element] = len(self.elements)
+                self.elements.append(element)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __repr__(self):
+        return '<ElementRegistry (%d elements)>' % len(self)
+
+registry = ElementRegistry()
+registry.add_lineconfigs(lineconfigs[k] for k in sorted(lineconfigs))
+
+_pool = None
+_pool_lock = Lock()
+
+def get_pool(processes):
+    """
+    Get the process pool used by `Manager.simulate`, creating it on first
+    use. It is kept for all later runs, as forking while other threads hold
+    locks may deadlock the new processes, so it should be created before
+    any other threads are started (see `zwl.scheduler`).
+
+    :return: tuple `(pool, known)`, `known` being the number of elements in
+             `registry` when the pool was created, which the processes know
+             about
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool[0]._processes != processes:
+            if _pool is not None:
+                _pool[0].close()
+            _pool = (Pool(processes), len(registry))
+        return _pool
+
+def _simulate_component(args):
+    """
+    Simulate a group of journeys in a process of the pool used by
+    `Manager.simulate`.
+
+    :return: tuple `(predictions, timelines, stats, incomplete, deadlocks)`,
+             with `predictions` being lists of `(arr_pred, dep_pred)`
+             tuples, one list per journey, `timelines` being of the form
+             {element tuple: list of `(journey index, start, end)` tuples},
+             `stats` being a `PredictionStats` object or None, `incomplete`
+             being the indices of the incomplete journeys and `deadlocks`
+             being the deadlocks found, as lists of journey indices.
+    """
+    journeys, now, collect_stats, deadline, step_budget, known, added = args
+    registry.sync(known, added)
+    stats = PredictionStats() if collect_stats else None
+    time_budget = None
+    if deadline is not None:
+        time_budget = max(0, deadline - ttime())
+    manager = Manager(journeys, now, processes=1, stats=stats,
+                      time_budget=time_budget, step_budget=step_budget)
+    manager.simulate()
+    if stats is not None:
+        # counted in the calling process already
+        stats.journeys = 0
+
+    index = {j: i for i, j in enumerate(journeys)}
+    # element ids interned in this process are unknown to the caller
+    timelines = {registry.elements[e]:
+                     [(index[o.journey], o.start, o.end) for o in timeline]
+                 for e, timeline in manager.timelines.items()}
+    return ([[(stop.arr_pred, stop.dep_pred) for stop in j.timetable]
+             for j in journeys], timelines, stats,
+            [index[j] for j in manager.incomplete],
+            [[index[j] for j in cycle] for cycle in manager.deadlocks])
+
+_tte = TimetableEntry.__table__
+_update_predictions = _tte.update() \
+    .where(_tte.c.id == bindparam('_id')) \
+    .values({_tte.c.ankunft_prognose: bindparam('_arr_pred'),
+             _tte.c.abfahrt_prognose: bindparam('_dep_pred')})
+
+def get_trains_within_horizon(starttime, interval=None):
+    """
+    Get all trains running within `interval` seconds (defaults to
+    config.PREDICTION_INTERVAL) from `starttime`.
+    """
+    if interval is None:
+        interval = app.config['PREDICTION_INTERVAL']
+    start = datetime.combine(date(1,1,1), starttime)
+    end = start + timedelta(seconds=interval)
+    if end.date() != start.date():
+        end = datetime.combine(start.date(), time(23,59,59)) #TODO after-midnight support
+    endtime = end.time()
+
+    q = db.session.query(TimetableEntry.train_id) \
+        .filter(TimetableEntry.sorttime.between(starttime, endtime))
+
+    return Train.query.filter(Train.id.in_(q)).all()
+
+def get_timetables(trains):
+    """
+    Fetch the timetables of all given trains in one query.
+
+    :return: dict of the form {train id: list of `TimetableEntry` objects},
+             sorted by time.
+    """
+    timetables = defaultdict(list)
+    if not trains:
+        return timetables
+
+    entries = TimetableEntry.query \
+        .filter(TimetableEntry.train_id.in_([t.id for t in trains])) \
+        .order_by(TimetableEntry.train_id, TimetableEntry.sorttime).all()
+    for e in entries:
+        timetables[e.train_id].append(e)
+    return timetables
+
+def find_current_position(timetable):
+    """Find the latest timetable entry where the train has already been."""
+    for i, e in reversed(list(enumerate(timetable))):
+        if e.arr_real is not None or e.dep_real is not None:
+            return i
+    return 0
+
+def find_journey_elements(timetable):
+    """
+    Get all elements the train may occupy from its current position on.
+    This is a superset of the elements required by the journey's actions.
+    """
+    elements = set()
+    position = find_current_position(timetable)
+    for i in range(position, len(timetable)):
+        e = timetable[i]
+        elements.add((e.loc, e.track_want))
+        if e.track_real is not None:
+            elements.add((e.loc, e.track_real))
+        if i+1 < len(timetable):
+            elements.add(('line', e.loc, timetable[i+1].loc))
+    return elements
+
+def find_components(journeys):
+    """
+    Split `journeys` into groups that don't share any elements, so each
+    group can be simulated independently. Must be called before the
+    journeys are run.
+
+    :return: list of lists of journeys. The groups are ordered by their
+             first journey; within a group, journeys keep their order.
+    """
+    parent = range(len(journeys))
+    def _root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    users = {}
+    for i, j in enumerate(journeys):
+        for e in j.element_ids():
+            if e in users:
+                parent[_root(i)] = _root(users[e])
+            else:
+                users[e] = i
+
+    components = OrderedDict()
+    for i, j in enumerate(journeys):
+        components.setdefault(_root(i), []).append(j)
+    return components.values()
+
+def find_affected_trains(states, trains, elements):
+    """
+    Find all trains that need to be simulated again.
+
+    These are the given `trains`, all trains that may occupy one of the given
+    `elements`, and, transitively, all trains sharing elements with those.
+
+    :param states: dict of the form {train id: TrainState}
+    """
+    users = defaultdict(list)
+    for tid, state in states.items():
+        for e in state.elements:
+            users[e].append(tid)
+
+    affected = set(trains)
+    pending = set(elements)
+    for tid in trains:
+        pending.update(states[tid].elements)
+
+    seen = set()
+    while pending:
+        e = pending.pop()
+        seen.add(e)
+        for tid in users[e]:
+            if tid not in affected:
+                affected.add(tid)
+                pending.update(states[tid].elements - seen)
+
+    return affected
+
+def plan_key(train, timetable):
+    """
+    Summarize the data a `JourneyPlan` is compiled from, i.e. all data of
+    the train's timetable except for the times.
+    """
+    return tuple((e.id, e.loc, e.track_want, e.min_ridetime, e.min_stoptime)
+                 for e in timetable)
+
+def get_plan(plans, train, timetable):
+    """
+    Return the `JourneyPlan` of `train` from `plans` (of the form {train id:
+    JourneyPlan}), or a new one if its timetable changed in a way that
+    matters.
+    """
+    plan = plans.get(train.id)
+    if plan is None or plan.key != plan_key(train, timetable):
+        plan = JourneyPlan(train, timetable)
+    return plan
+
+def fingerprint(train, timetable):
+    """
+    Summarize all data the prediction of `train` is based on, so changes
+    can be detected by comparison.
+    """
+    return (train.type_id,) + tuple(
+        (e.id, e.loc, e.arr_want, e.dep_want, e.arr_real, e.dep_real,
+         e.track_want, e.track_real, e.min_ridetime, e.min_stoptime)
+        for e in timetable)
+
+
+class ActionQueue(object):
+    """
+    Priority queue of `QueueEntry` objects, ordered by the time of their
+    `next_action`.
+
+    An entry whose action changes (e.g. because it was not admitted) has to
+    be popped and pushed again to be re-keyed.
+
+    Of the entries with the same time, the one pushed last is returned
+    first, followed by the initial `entries` in their order. This is the
+    order the simulation has always used (a stable sort of a list, with the
+    entry just processed in front), which decides the trains' order when
+    they compete for an element, so it must not change.
+    """
+    def __init__(self, entries=()):
+        self._heap = [(e.next_action.time, i, e)
+                      for i, e in enumerate(entries)]
+        heapify(self._heap)
+        self._counter = count(-1, -1)
+
+    def push(self, entry):
+        heappush(self._heap,
+                 (entry.next_action.time, next(self._counter), entry))
+
+    def pop(self):
+        return heappop(self._heap)[2]
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class Timeline(object):
+    """
+    All occupations of one element, ordered by their start time.
+
+    Occupations of an element never overlap, so they are ordered by their
+    end time as well, which allows to find them using binary search.
+    Only the last one may be open (its `end` being None).
+    """
+    def __init__(self):
+        self._starts = []
+        self._occupancies = []
+
+    def add(self, occupancy):
+        i = bisect_right(self._starts, occupancy.start)
+        self._starts.insert(i, occupancy.start)
+        self._occupancies.insert(i, occupancy)
+
+    def overlapping(self, start, end=None):
+        """
+        Get the occupations overlapping the interval from `start` to `end`
+        (exclusive), or starting at `start` if `end` is None.
+        """
+        i = bisect_right(self._starts, start) - 1
+        if i < 0 or self._ends_before(self._occupancies[i], start):
+            i += 1
+        if end is None:
+            end = start + 1
+        j = i
+        while j < len(self._starts) and self._starts[j] < end:
+            j += 1
+        return self._occupancies[i:j]
+
+    def occupant(self, time):
+        """Get the journey occupying the element at `time`, if any."""
+        occupancies = self.overlapping(time)
+        return occupancies[0].journey if occupancies else None
+
+    def free_after(self, time, duration=0):
+        """
+        Find the earliest time not before `time` from which on the element
+        is free for at least `duration` seconds.
+
+        :return: seconds, or None if the element is not freed anymore
+        """
+        i = bisect_right(self._starts, time) - 1
+        if i < 0:
+            i = 0
+        candidate = time
+        for occupancy in self._occupancies[i:]:
+            if self._ends_before(occupancy, candidate):
+                continue
+            if occupancy.start >= candidate + max(duration, 1):
+                break
+            if occupancy.end is None:
+                return None
+            candidate = occupancy.end
+        return candidate
+
+    @staticmethod
+    def _ends_before(occupancy, time):
+        return occupancy.end is not None and occupancy.end <= time
+
+    def __iter__(self):
+        return iter(self._occupancies)
+
+    def __len__(self):
+        return len(self._occupancies)
+
+    def __repr__(self):
+        return '<Timeline (%d occupations)>' % len(self)
 
 
 class Action(object):
@@ -259,55 +1585,68 @@ class Action(object):
 
     `Action` objects yielded by the Journey and acted upon by the Manager.
 
-    :param time: Time when the action is carried out (`datetime.time` object)
+    :param time: Time when the action is carried out (in seconds, see
+                 `zwl.utils.time2seconds`).
                  For conditional actions, this is the time when the Journey
                  wishes to carry out the action.
     """
-    def __init__(self, journey, time):
+    def __init__(self, journey, time, required_elements=()):
         self.journey = journey
         assert time is not None
         self.time = time
 
         self.manager = None
-        self.required_elements = self.find_required_elements()
+        # element ids, see `ElementRegistry`. The list must not be modified.
+        self.required_elements = required_elements
 
     def set_expected_release_time(self, rtime):
         for e in self.required_elements:
-            assert self.manager.elements[e]
             self.manager.elements[e].expected_release_time = rtime
 
     def allocate(self, manager):
         assert self.manager is None, 'must be called only once'
 
         self.manager = manager
-        expected_release_times = []
+        blocking = None
 
         # check if we could execute the action
-        for elem_name in self.required_elements:
-            elem = manager.elements[elem_name]
+        elements = manager.elements
+        for e in self.required_elements:
+            elem = elements[e]
             if elem is None or elem.journey is self.journey:
                 continue
             assert elem.expected_release_time is not None
-            expected_release_times.append(elem.expected_release_time)
+            if blocking is None or elem.expected_release_time > \
+                    elements[blocking].expected_release_time:
+                blocking = e
+            if manager.stats is not None:
+                manager.stats.not_free[registry.elements[e]] += 1
 
         # we cannot, there are occupied elements
-        if expected_release_times:
-            expected_release_time = timeadd(max(expected_release_times),
-                    timedelta(seconds=1))
-            assert expected_release_time > self.time
-            return NotFree(expected_release_time)
-
-        # mark required elements
-        for elem_name in self.required_elements:
-            manager.elements[elem_name] = Occupancy(self.journey, None)
-
-        for elem_name in manager.elements:
-            if manager.elements[elem_name] is None:
-                continue
-            if manager.elements[elem_name].journey is self.journey:
-                if elem_name not in self.required_elements:
-                    manager.elements[elem_name] = None
+        if blocking is not None:
+            if manager.stats is not None:
+                manager.stats.not_free_responses += 1
+            # the estimate of a journey that is waiting itself may be
+            # outdated already
+            expected_release_time = max(self.time,
+                manager.elements[blocking].expected_release_time) + 1
+            return NotFree(expected_release_time, blocking)
+
+        # mark required elements, free those no longer needed
+        manager.occupy(self.journey, self.required_elements)
+
+        return Admitted()
+
+    def admit(self, manager):
+        """
+        Carry out the action without checking whether the elements are free,
+        for journeys that don't share any elements with other journeys (see
+        `Manager.simulate`).
+        """
+        assert self.manager is None, 'must be called only once'
 
+        self.manager = manager
+        manager.occupy(self.journey, self.required_elements)
         return Admitted()
 
 
@@ -318,16 +1657,14 @@ class Arrive(Action):
     When used, the location is marked as occupied by the train. If the train
     had carried out a `Ride` action before, those track elements are freed.
     """
-    def __init__(self, journey, time, loc):
+    def __init__(self, journey, time, loc, required_elements):
         self.loc = loc
-        super(Arrive, self).__init__(journey, time)
-
-    def find_required_elements(self):
-        return [(self.loc.code, self.loc.track)]
+        super(Arrive, self).__init__(journey, time, required_elements)
 
     def __repr__(self):
         return '<Arrive %r %s at %s[%s]>' % (self.journey,
-                self.time.strftime('%T'), self.loc.code, self.loc.track)
+                seconds2time(self.time).strftime('%T'), self.loc.code,
+                self.loc.track)
 
 
 class Ride(Action):
@@ -339,35 +1676,29 @@ class Ride(Action):
 
     :param start: start location and track
     :param end: end location and track
+    :param required_elements: ids of `start`, the line from `start` to
+                              `end` and `end`
     :param succ: location after end, if available. Needed for correct routing.
     """
-    def __init__(self, journey, time, start, end, succ=None):
+    def __init__(self, journey, time, start, end, required_elements,
+                 succ=None):
         self.start = start
         self.end = end
         self.succ = succ
-        super(Ride, self).__init__(journey, time)
-
-    def find_required_elements(self):
-        return [
-            (self.start.code, self.start.track),
-            ('line', self.start.code, self.end.code),
-            (self.end.code, self.end.track),
-        ]
+        super(Ride, self).__init__(journey, time, required_elements)
 
     def __repr__(self):
         return '<Ride %r %s from %s[%s] to %s[%s]>' % (self.journey,
-                self.time.strftime('%T'), self.start.code, self.start.track,
-                self.end.code, self.end.track)
+                seconds2time(self.time).strftime('%T'), self.start.code,
+                self.start.track, self.end.code, self.end.track)
 
 class EndJourney(Action):
     """
     Train's ride has ended, remove occupation markings.
     """
-    def find_required_elements(self):
-        return []
-
     def __repr__(self):
-        return '<EndRide %r %s>' % (self.journey, self.time.strftime('%T'))
+        return '<EndRide %r %s>' % (self.journey,
+                seconds2time(self.time).strftime('%T'))
 
 class Response(object):
     """
@@ -388,15 +1719,21 @@ class NotFree(Response):
     Response meaning: The desired action is not possible at the desired time
     due to lack of free tracks. They are expected to be free at
     `expected_release_time`.
+
+    :param element: the element blocking the action (the one expected to be
+                    released last)
     """
-    def __init__(self, expected_release_time):
+    def __init__(self, expected_release_time, element=None):
         self.expected_release_time = expected_release_time
+        self.element = element
         super(NotFree, self).__init__()
 
     def __repr__(self):
-        return '<NotFree expected_release_time=%s>' % self.expected_release_time
+        return '<NotFree expected_release_time=%s>' % \
+            seconds2time(self.expected_release_time)
 
 Location = namedtuple('Location', ['code', 'track'])
-Occupancy = writable_namedtuple('Occupancy', ['journey', 'expected_release_time'])
+Occupancy = writable_namedtuple('Occupancy', ['journey', 'start', 'end', 'expected_release_time'])
 
 QueueEntry = writable_namedtuple('QueueEntry', ('journey', 'runner', 'next_action'))
+TrainState = writable_namedtuple('TrainState', ('fingerprint', 'elements', 'earliest_prediction'))
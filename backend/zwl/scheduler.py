@@ -0,0 +1,148 @@
+# -*- coding: utf8 -*-
+"""
+    zwl.scheduler
+    =============
+
+    Background thread periodically updating the predictions.
+
+    :copyright: (c) 2015, Marian Sigler
+    :license: GNU GPL 2.0 or later.
+"""
+
+from threading import Event, Lock, Thread
+from time import time as ttime
+from zwl import app, db
+from zwl.predict import Predictor, get_pool
+from zwl.utils import get_time, time2js, ClockConnectionError
+
+class PredictionScheduler(object):
+    """
+    Runs a `Predictor` every `interval` seconds, using the simulation time
+    from the clock server.
+
+    Runs are aligned to multiples of `interval` and never overlap, as they
+    are all carried out by one thread. While the clock is stopped, scheduled
+    runs are skipped; runs requested using `trigger()` are carried out
+    anyway.
+    """
+    def __init__(self, predictor, interval=None):
+        self.predictor = predictor
+        self._interval = interval
+
+        self.running = False
+        self.pending = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_trains = None
+        self.last_written = None
+        self.last_incomplete = None
+        self.last_error = None
+        self.last_stats = None
+
+        self._thread = None
+        self._wakeup = Event()
+        self._lock = Lock()
+
+    @property
+    def interval(self):
+        if self._interval is not None:
+            return self._interval
+        return (app.config['PREDICTION_REFRESH_INTERVAL']
+                or app.config['REFRESH_INTERVAL'])
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start the scheduler thread, if it is not running yet."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            # processes must not be forked from the thread, see `get_pool`
+            if app.config['PREDICTION_PROCESSES'] > 1:
+                get_pool(app.config['PREDICTION_PROCESSES'])
+            self._thread = Thread(target=self._loop,
+                                  name='PredictionScheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def trigger(self):
+        """Request a run as soon as possible."""
+        with self._lock:
+            self.pending += 1
+        self._wakeup.set()
+
+    def status(self):
+        return dict(
+            running=self.running,
+            pending=self.pending,
+            interval=self.interval,
+            last_run=time2js(self.last_run and self.last_run.time()),
+            last_duration=self.last_duration,
+            last_trains=self.last_trains,
+            last_written=self.last_written,
+            last_incomplete=self.last_incomplete,
+            last_error=self.last_error,
+        )
+
+    def _loop(self):
+        while True:
+            # sleep until the next multiple of `interval`
+            self._wakeup.wait(self.interval - ttime() % self.interval)
+            with self._lock:
+                triggered = self.pending > 0
+                self.pending = 0
+                self._wakeup.clear()
+
+            try:
+                with app.app_context():
+                    self.run(force=triggered)
+            except Exception:
+                app.logger.exception('Prediction run failed')
+
+    def run(self, force=False):
+        """
+        Update the predictions, unless the clock is stopped and `force` is
+        not set.
+
+        :return: whether the predictions were updated
+        """
+        try:
+            state, now = get_time()
+        except ClockConnectionError, e:
+            self.last_error = str(e)
+            return False
+
+        if state == 'stopped' and not force:
+            return False
+
+        self.running = True
+        start = ttime()
+        try:
+            manager = self.predictor.run(now.time())
+            db.session.commit()
+        except Exception, e:
+            db.session.rollback()
+            # the predictor's state describes what was rolled back
+            self.predictor.invalidate()
+            self.last_error = str(e)
+            raise
+        finally:
+            self.running = False
+
+        self.last_run = now
+        self.last_duration = ttime() - start
+        self.last_trains = len(manager.journeys)
+        self.last_written = manager.written
+        self.last_incomplete = len(manager.incomplete)
+        self.last_error = None
+        self.last_stats = manager.stats and manager.stats.as_dict()
+        return True
+
+scheduler = PredictionScheduler(Predictor())
+
+@app.before_first_request
+def start_scheduler():
+    if app.config['PREDICTION_SCHEDULER']:
+        scheduler.start()
@@ -11,22 +11,33 @@
 """
 
 import itertools
+import json
+import operator
 import os
 import tempfile
 import unittest
 import warnings
-from datetime import timedelta, time
-from zwl import app, db, trains
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, time
+from sqlalchemy import event
+from zwl import app, db, scheduler, trains, views
 from zwl.database import *
-from zwl.lines import get_lineconfig
-from zwl.predict import Manager, Journey
-from zwl.utils import MidnightWarning, timeadd, timediff
+from zwl.extra.generate import generate_session, find_current_elements
+from zwl.lines import get_lineconfig, lineconfigs
+from zwl.predict import Action, Manager, Journey, Predictor, PredictionStats, \
+        ElementRegistry, registry, find_components, get_timetables, \
+        get_trains_within_horizon, get_pool, ActionQueue, QueueEntry, \
+        Scenario
+from zwl.utils import MidnightWarning, timeadd, timediff, time2seconds, \
+        seconds2time, time2js
 
 class ZWLTestCase(unittest.TestCase):
     def _setup_database(self):
         self.db_fd, self.db = tempfile.mkstemp()
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % self.db
         app.config['TESTING'] = True
+        app.config['PREDICTION_SCHEDULER'] = False
         self.app = app.test_client()
         db.metadata.create_all(bind=db.engine)
 
@@ -36,6 +47,103 @@ class ZWLTestCase(unittest.TestCase):
         #TODO: unlinking (in connection with s/flush/commit/) breaks everything?!
         #os.unlink(self.db)
 
+    @contextmanager
+    def count_queries(self):
+        """
+        Count the SQL statements executed within the `with` block.
+        The number is available as `len()` of the yielded list.
+        """
+        db.session.flush()
+        # listen on the session's connection, as listeners added to the
+        # engine don't apply to connections that already exist
+        conn = db.session.connection()
+        statements = []
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(conn, 'before_cursor_execute', _count)
+        try:
+            yield statements
+        finally:
+            event.remove(conn, 'before_cursor_execute', _count)
+
+def _legacy_make_timetable(train, timetable_entries, line):
+    """
+    `zwl.trains.make_timetable` as it was before the timetable was indexed,
+    searching lists of location codes instead.
+    """
+    timetable_entries.sort(key=operator.attrgetter('sorttime'))
+    timetable_locations = [e.loc for e in timetable_entries]
+
+    def _add(seg, loc, tte, **kwargs):
+        if loc.display_label:
+            kwargs['track_plan'] = tte.track_plan
+        seg['timetable'].append(dict(loc=loc.id,
+            arr_plan=time2js(tte.arr_plan), dep_plan=time2js(tte.dep_plan),
+            **kwargs))
+
+    segments = []
+    locations = deque(line.locations)
+    while locations:
+        cur_seg = {'timetable': []}
+        starti = None
+        while locations:
+            loc = locations.popleft()
+            if loc.code in timetable_locations:
+                starti = timetable_locations.index(loc.code)
+                _add(cur_seg, loc, timetable_entries[starti])
+                break
+        if starti is None:
+            break
+
+        try:
+            i, loc = _legacy_find_next_common_location(locations,
+                timetable_locations, starti)
+        except trains.NoMatchFound:
+            break
+        _add(cur_seg, loc, timetable_entries[i])
+        direction = -1 if i < starti else +1
+        cur_seg['direction'] = 'left' if i < starti else 'right'
+
+        while locations:
+            try:
+                i, loc = _legacy_find_next_common_location(locations,
+                    timetable_locations, i, direction)
+            except trains.NoMatchFound:
+                break
+            _add(cur_seg, loc, timetable_entries[i])
+
+        if direction == -1:
+            cur_seg['timetable'].reverse()
+        segments.append(cur_seg)
+
+    return segments
+
+def _legacy_find_next_common_location(locations, timetable_locations, starti,
+        direction=None, loc_threshold=3, tt_threshold=3):
+    def _within_threshold(i):
+        if direction is None:
+            return abs(starti - i) < tt_threshold
+        if direction == +1:
+            return starti < i <= (starti + tt_threshold)
+        return starti > i >= (starti - tt_threshold)
+
+    pushback = deque()
+    for _ in range(loc_threshold):
+        if not locations:
+            break
+        loc = locations.popleft()
+        pushback.appendleft(loc)
+        try:
+            i = timetable_locations.index(loc.code)
+        except ValueError:
+            continue
+        if _within_threshold(i):
+            return i, loc
+
+    locations.extendleft(pushback)
+    raise trains.NoMatchFound()
+
+
 class TestTrains(ZWLTestCase):
     def setUp(self):
         self._setup_database()
@@ -92,6 +200,137 @@ class TestTrains(ZWLTestCase):
         #assert allelemsd['XDE#2']['succ'] == 'XCE'
         #assert allelemsd['XLG#1']['pred'] == 'XWF'
 
+    def test_get_train_information_queries(self):
+        """Test that train information is fetched with a single query"""
+        self.t1.transition_to_id = self.t3.id
+        self.t3.transition_from_id = self.t1.id
+        created = generate_session(20, seed=1)
+        line = get_lineconfig('ring-xwf')
+
+        counts = []
+        for train_ids in ([self.t1.id], [t.id for t in created]):
+            db.session.flush()
+            # nothing may be loaded from the identity map
+            db.session.expunge_all()
+            with self.count_queries() as queries:
+                res = list(trains.get_train_information(train_ids, line))
+            counts.append(len(queries))
+        self.assertEqual(counts, [1, 1])
+        self.assertTrue(len(res) > 10)
+        self.assertTrue(all(r['type'] for r in res))
+
+        # the trains may be selected by a subquery, too
+        q = trains.train_ids_query(time(0,0), time(23,59), line)
+        with self.count_queries() as queries:
+            res2 = list(trains.get_train_information(q, line))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(sorted(r['id'] for r in res2),
+                         sorted(r['id'] for r in res))
+
+        res = trains.get_train_information([self.t1.id, self.t3.id],
+                                           get_lineconfig('sample'))
+        transitions = {r['nr']: (r['transition_from'], r['transition_to'])
+                       for r in res}
+        self.assertEqual(transitions, {700: (None, 2342), 2342: (700, None)})
+
+    def test_make_timetable(self):
+        """Test that the segments are the same as with the former algorithm"""
+        created = generate_session(40, seed=1)
+        # trains passing a location twice, and running in both directions
+        created.extend([self.t1, self.t3])
+        self.t3.timetable_entries.filter_by(loc='XCE').one().loc = 'XLG'
+        db.session.flush()
+
+        timetables = get_timetables(created)
+        compared = 0
+        for id, line in sorted(lineconfigs.items()):
+            records = trains.get_train_records([t.id for t in created],
+                                               set(line.locationcodes))
+            for train in created:
+                timetable = timetables[train.id]
+                segments = trains.make_timetable(train, list(timetable), line)
+                self.assertEqual(segments, _legacy_make_timetable(train,
+                    list(timetable), line), (id, train))
+                self.assertEqual(segments, trains.make_timetable(train,
+                    records[train.id].timetable, line), (id, train))
+                compared += len(segments)
+        self.assertTrue(compared > 100)
+
+    def test_get_train_records(self):
+        self.t3.transition_from_id = self.t1.id
+        db.session.flush()
+        records = trains.get_train_records([self.t1.id, self.t3.id])
+        self.assertEqual(records.keys(), [self.t1.id, self.t3.id])
+        t3 = records[self.t3.id]
+        self.assertEqual((t3.nr, t3.type, t3.transition_from, t3.transition_to),
+                         (2342, 'RE', 700, None))
+        self.assertEqual([(r.position, r.loc) for r in t3.timetable],
+            [(0, 'XPN'), (1, 'XLG'), (2, 'XWF'), (3, 'XCE'), (4, 'XDE')])
+        xlg = records[self.t1.id].timetable[1]
+        self.assertEqual((xlg.arr_plan, xlg.dep_plan, xlg.sorttime),
+                         (time(15,34), time(15,34), time(15,34)))
+
+        # the first and last entries are always included
+        records = trains.get_train_records([self.t1.id, self.t3.id],
+                                           {'XLG', 'XWF'})
+        self.assertEqual([(r.position, r.loc)
+                          for r in records[self.t1.id].timetable],
+            [(0, 'XWF'), (1, 'XLG'), (4, 'XCE')])
+        self.assertEqual([(r.position, r.loc)
+                          for r in records[self.t3.id].timetable],
+            [(0, 'XPN'), (1, 'XLG'), (2, 'XWF'), (4, 'XDE')])
+
+    def test_graph_data_cache(self):
+        self.addCleanup(app.config.update, GRAPHDATA_CACHE_CHECK_INTERVAL=
+                        app.config['GRAPHDATA_CACHE_CHECK_INTERVAL'])
+        app.config['GRAPHDATA_CACHE_CHECK_INTERVAL'] = 0
+        cache = trains.graphdata_cache
+        cache.clear()
+        self.addCleanup(cache.clear)
+        hits, misses, invalidations = \
+            cache.hits, cache.misses, cache.invalidations
+        line = get_lineconfig('sample')
+
+        res = trains.get_graph_data(line, time(15,30,10), time(16,0))
+        self.assertEqual([t['nr'] for t in res], [700])
+        # the same minutes, so the same (quantized) time window
+        self.assertIs(trains.get_graph_data(line, time(15,30), time(15,59,30)), res)
+        self.assertIsNot(trains.get_graph_data(line, time(15,30), time(16,1)), res)
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 2))
+
+        # predictions are not part of the results
+        xlg = self.t1.timetable_entries.filter_by(loc='XLG').one()
+        xlg.arr_pred = time(15,37)
+        db.session.flush()
+        self.assertIs(trains.get_graph_data(line, time(15,30), time(16,0)), res)
+        self.assertEqual(cache.invalidations, invalidations)
+
+        xlg.arr_plan = time(15,33)
+        db.session.flush()
+        new = trains.get_graph_data(line, time(15,30), time(16,0))
+        self.assertIsNot(new, res)
+        self.assertEqual(cache.invalidations - invalidations, 1)
+        arr_plans = [e['arr_plan'] for seg in new[0]['segments']
+                     for e in seg['timetable'] if e['loc'] == 'XLG#1']
+        self.assertEqual(arr_plans, [time2js(time(15,33))])
+
+        rv = self.app.get('/graphdata/cache')
+        self.assertEqual(json.loads(rv.data), cache.stats())
+        self.assertEqual(cache.stats()['size'], 1)
+
+    def test_graph_data_cache_eviction(self):
+        cache = trains.GraphDataCache(size=2)
+        computed = []
+        def _get(key):
+            return cache.get(key, lambda: computed.append(key) or key)
+
+        for key in 'abacb':
+            self.assertEqual(_get(key), key)
+        # 'a' was used more recently than 'b' when 'c' was added
+        self.assertEqual(computed, ['a', 'b', 'c', 'b'])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 4, 2))
+        self.assertEqual(cache.stats()['size'], 2)
+
     def test_locations_extended_between(self):
         line = get_lineconfig('sample')
         locs = list(line.locations_extended_between())
@@ -143,6 +382,29 @@ class TestDatabase(ZWLTestCase):
         self.assertEquals(MinimumStopTime.lookup(self.re, 'XDE'), 45)
         self.assertEquals(MinimumStopTime.lookup(self.re, 'XDE', 1), 45)
 
+    def test_minimum_stop_time_table(self):
+        # exercise SQL's NULL handling: `loc = 'XPN' AND track = 2` is NULL
+        db.session.add(MinimumStopTime(77, self.re.id, None, 2))
+        table = MinimumStopTimeTable()
+        for traintype in (self.ic, self.re, self.ic.id, None):
+            for loc in (None, 'XPN', 'XDE'):
+                for track in (None, 1, 2, 3):
+                    if loc is None and track is not None:
+                        continue
+                    self.assertEqual(table.lookup(traintype, loc, track),
+                        MinimumStopTime.lookup(traintype, loc, track),
+                        (traintype, loc, track))
+
+        with self.count_queries() as queries:
+            self.assertEqual(table.lookup(self.ic, 'XPN', 3), 203)
+            self.assertEqual(table.lookup(self.re, 'XWF', 2), 45)
+        self.assertEqual(len(queries), 0)
+
+        db.session.add(MinimumStopTime(50, self.re.id, None, None))
+        self.assertEqual(table.lookup(self.re, 'XWF', 2), 45)
+        table.invalidate()
+        self.assertEqual(table.lookup(self.re, 'XWF', 2), 50)
+
     def tearDown(self):
         self._teardown_database()
 
@@ -171,6 +433,13 @@ class TestUtils(ZWLTestCase):
         with self.assertRaises(ValueError):
             timeadd(time(10,20), timedelta(hours=9))
 
+    def test_time2seconds(self):
+        self.assertEqual(time2seconds(time(16,27,45)), 59265)
+        self.assertEqual(seconds2time(59265), time(16,27,45))
+        self.assertEqual(seconds2time(86400 + 75), time(0,1,15))
+        self.assertEqual(time2seconds(None), None)
+        self.assertEqual(seconds2time(None), None)
+
 class TestPredict(ZWLTestCase):
     maxDiff = 2000
 
@@ -338,8 +607,603 @@ XDE_F  16:34:45 16:34:45 None  None     None     None  16:37:20 16:37:20
 XDE    16:35:00 None     1     None     None     None  16:37:34 None    
 """)
 
+    def test_occupancy_index(self):
+        """Test that all elements are freed when the journeys have ended"""
+        manager = Manager.from_trains([self.t2, self.t3], time(16,27))
+        manager.run()
+        self.assertEqual(manager.occupied(), {})
+        self.assertEqual(dict(manager.held), {})
+
+    def test_element_registry(self):
+        """Test that elements are interned once, with dense ids"""
+        reg = ElementRegistry()
+        reg.add_lineconfigs([get_lineconfig('sample')])
+        self.assertEqual(reg.elements[:3], [('XDE', None), ('XCE', None),
+                                            ('XLG', None)])
+        self.assertEqual(reg.intern(('line', 'XCE', 'XDE')),
+                         reg.ids['line', 'XCE', 'XDE'])
+        n = len(reg)
+        self.assertEqual(reg.intern(('XCE', 2)), n)
+        self.assertEqual(reg.intern(('XCE', 2)), n)
+        self.assertEqual(len(reg), n+1)
+
+        # journeys carry the ids of the elements their actions need
+        journey = Journey(self.t2, time(16,10),
+                          get_timetables([self.t2])[self.t2.id])
+        xwf, xce_f = [stop.plan for stop in journey.timetable[:2]]
+        self.assertEqual([registry.elements[e] for e in xwf.ride],
+                         [('XWF', 1), ('line', 'XWF', 'XCE_F'), ('XCE_F', None)])
+        self.assertEqual([registry.elements[e] for e in xce_f.arrive_want],
+                         [('XCE_F', None)])
+
+    def test_timelines(self):
+        """Test that all occupations are recorded and can be queried"""
+        manager = Manager.from_trains([self.t2, self.t3], time(16,27))
+        manager.run()
+
+        def _occupations(e):
+            return [(o.journey.train.nr, seconds2time(o.start),
+                     seconds2time(o.end)) for o in manager.timeline(e)]
+        self.assertEqual(_occupations(('XCE_F', None)), [
+            (2004, time(16,27), time(16,30,37)),
+            (306, time(16,30,38), time(16,32,26))])
+
+        timeline = manager.timeline(('XCE_F', None))
+        s = time2seconds
+        self.assertEqual(timeline.occupant(s(time(16,30))).train, self.t2)
+        self.assertEqual(timeline.occupant(s(time(16,30,37))), None)
+        self.assertEqual(timeline.occupant(s(time(16,31))).train, self.t3)
+        self.assertEqual(len(timeline.overlapping(s(time(16,30)),
+                                                  s(time(16,31)))), 2)
+        self.assertEqual(timeline.overlapping(s(time(16,33))), [])
+
+        def _free_after(e, t, duration=0):
+            return seconds2time(manager.free_after(e, s(t), duration))
+        self.assertEqual(_free_after(('XCE_F', None), time(16,30)),
+                         time(16,30,37))
+        self.assertEqual(_free_after(('XCE_F', None), time(16,30), 60),
+                         time(16,32,26))
+        self.assertEqual(_free_after(('XCE_F', None), time(16,40)),
+                         time(16,40))
+        self.assertEqual(_free_after(('XSC', 1), time(16,30)), time(16,30))
+
+        # the same occupations are found when simulating in parallel
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, self.t3, t4]
+        serial = Manager.from_trains(trains, time(16,27))
+        serial.simulate()
+        parallel = Manager.from_trains(trains, time(16,27), processes=2)
+        parallel.simulate()
+        def _all(manager):
+            return sorted((e, o.journey.train_id, o.start, o.end)
+                          for e, timeline in manager.timelines.items()
+                          for o in timeline)
+        self.assertEqual(_all(serial), _all(parallel))
+
+    def test_deadlock(self):
+        """Test that trains blocking each other don't stall the simulation"""
+        # t5 waits at XDE_F for XCE[2], where t2 waits for XDE_F
+        t5 = Train(nr=2005, type_obj=self.t2.type_obj)
+        db.session.add(t5)
+        db.session.flush()
+        for loc, track, arr, dep, arr_real in (
+                ('XDE',   2,    None,           time(16,25),    None),
+                ('XDE_F', None, time(16,25,30), time(16,25,30), time(16,25,30)),
+                ('XCE',   2,    time(16,29),    None,           None)):
+            db.session.add(TimetableEntry(train_id=t5.id, loc=loc,
+                sorttime=arr or dep, arr_want=arr, dep_want=dep,
+                arr_real=arr_real, track_want=track))
+        # before t5 leaves XDE_F at 16:27 (it would win a tie with t2)
+        self.t2_timetable['XCE'].arr_real = time(16,26,30)
+        self.t2_timetable['XCE'].track_real = 2
+        db.session.flush()
+
+        manager = Manager.from_trains([self.t2, t5], time(16,27))
+        manager.stats = PredictionStats()
+        manager.run()
+        self.assertEqual(manager.occupied(), {})
+        # t2 closes the cycle and is stopped, so t5 can continue
+        self.assertEqual([[j.train for j in cycle]
+                          for cycle in manager.deadlocks], [[self.t2, t5]])
+        self.assertEqual(manager.stats.as_dict()['deadlocks'],
+                         [[self.t2.id, t5.id]])
+        self.assertEqual(self.t2_timetable['XCE'].dep_pred, time(16,28))
+        self.assertEqual(self.t2_timetable['XDE_F'].arr_pred, None)
+        self.assertEqual(t5.timetable_entries.filter_by(loc='XCE').one()
+                         .arr_pred, time(16,31,10))
+
+    def test_action_queue(self):
+        """Test the order of actions with the same time"""
+        # it decides which train gets an element both want at that time:
+        # the one just processed, then the others in their original order
+        entries = [QueueEntry(name, None, Action(None, t))
+                   for name, t in (('a', 10), ('b', 20), ('c', 20))]
+        queue = ActionQueue(entries)
+        a = queue.pop()
+        a.next_action = Action(None, 20)
+        queue.push(a)
+        self.assertEqual(queue.pop().journey, 'a')
+        a.next_action = Action(None, 30)
+        queue.push(a)
+        b = queue.pop()
+        self.assertEqual(b.journey, 'b')
+        b.next_action = Action(None, 30)
+        queue.push(b)
+        self.assertEqual([queue.pop().journey for i in range(len(queue))],
+                         ['c', 'b', 'a'])
+
+    def test_timetable_prefetch(self):
+        """Test that timetables are fetched with a constant number of queries"""
+        with self.count_queries() as one:
+            Manager.from_trains([self.t1], time(16,10))
+        with self.count_queries() as three:
+            Manager.from_trains([self.t1, self.t2, self.t3], time(16,10))
+        self.assertEqual(len(one), 1)
+        self.assertEqual(len(three), 1)
+
+    def test_write_back(self):
+        """Test that predictions are written in one statement, if changed"""
+        with self.count_queries() as queries:
+            written = Manager.from_trains([self.t2, self.t3], time(16,27)).run()
+            db.session.flush()
+        self.assertEqual(written, 10)
+        self.assertEqual([q.split()[0] for q in queries], ['SELECT', 'SELECT',
+                                                           'UPDATE'])
+
+        rows = db.session.execute(db.select(
+            [TimetableEntry.arr_pred, TimetableEntry.dep_pred]).where(
+            TimetableEntry.id == self.t3_timetable['XCE'].id)).fetchall()
+        self.assertEqual(rows, [(time(16,32,26), time(16,34,51))])
+
+        with self.count_queries() as queries:
+            written = Manager.from_trains([self.t2, self.t3], time(16,27)).run()
+            db.session.flush()
+        self.assertEqual(written, 0)
+        self.assertEqual([q.split()[0] for q in queries], ['SELECT', 'SELECT'])
+
+    def _add_separate_train(self):
+        """
+        Add a train not sharing any elements with the others.
+        :return: tuple (train, list of timetable entries)
+        """
+        t4 = Train(nr=4711, type_obj=self.t2.type_obj)
+        db.session.add(t4)
+        db.session.flush()
+        t4_timetable = []
+        for loc, arr, dep in (('XPN', None, time(16,20)),
+                              ('XTS', time(16,24), time(16,25)),
+                              ('XSC', time(16,29), None)):
+            e = TimetableEntry(train_id=t4.id, loc=loc, sorttime=arr or dep,
+                arr_want=arr, dep_want=dep, track_want=1)
+            t4_timetable.append(e)
+            db.session.add(e)
+        db.session.flush()
+        return t4, t4_timetable
+
+    def test_parallel(self):
+        """Test that parallel simulation gives the same results"""
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, t4, self.t3]
+
+        manager = Manager.from_trains(trains, time(16,27))
+        self.assertEqual(
+            [[j.train.nr for j in c] for c in find_components(manager.journeys)],
+            [[2004, 306], [4711]])
+
+        manager.run()
+        serial = [format_timetable(t) for t in trains]
+        Manager.from_trains(trains, time(16,10)).run()
+        Manager.from_trains(trains, time(16,27), processes=2).run()
+        self.assertEqual(serial, [format_timetable(t) for t in trains])
+
+        # the pool is kept, and learns about elements added since
+        pool = get_pool(2)
+        t4_timetable[1].track_want = 17
+        manager = Manager.from_trains(trains, time(16,27))
+        manager.run()
+        serial = [format_timetable(t) for t in trains]
+        self.assertTrue(manager.timeline(('XTS', 17)))
+        Manager.from_trains(trains, time(16,10)).run()
+        manager = Manager.from_trains(trains, time(16,27), processes=2)
+        manager.run()
+        self.assertEqual(serial, [format_timetable(t) for t in trains])
+        self.assertTrue(manager.timeline(('XTS', 17)))
+        self.assertIs(get_pool(2), pool)
+
+    def test_run_alone(self):
+        """Test that journeys sharing no elements skip the allocation"""
+        t4, t4_timetable = self._add_separate_train()
+        manager = Manager.from_trains([self.t2, t4, self.t3], time(16,10))
+
+        allocated = []
+        allocate = Action.allocate
+        def _allocate(action, manager):
+            allocated.append(action.journey.train)
+            return allocate(action, manager)
+        Action.allocate = _allocate
+        try:
+            manager.run()
+        finally:
+            Action.allocate = allocate
+
+        self.assertNotIn(t4, allocated)
+        self.assertEqual(t4_timetable[1].arr_pred, time(16,24))
+        self.assertEqual(t4_timetable[2].arr_pred, time(16,29))
+        self.assertEqual(
+            [(o.start, o.end) for o in manager.timeline(('XTS', 1))],
+            [(time2seconds(time(16,20)), time2seconds(time(16,29)))])
+        self.assertEqual(manager.occupied(), {})
+
+    def test_stats(self):
+        """Test collection of statistics"""
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, self.t3, t4]
+
+        manager = Predictor().run(time(16,27), trains)
+        stats = manager.stats.as_dict()
+        self.assertEqual(stats['trains'], 3)
+        self.assertEqual(stats['journeys'], 3)
+        self.assertEqual(stats['actions'], 27)
+        self.assertEqual(stats['not_free'], 4)
+        self.assertEqual(stats['not_free_elements'][:3],
+                         [{'element': 'XCE_F[None]', 'count': 2},
+                          {'element': 'XDE_F[None]', 'count': 2},
+                          {'element': 'XWF[1]', 'count': 1}])
+        self.assertEqual(stats['longest_journeys'],
+                         [{'train_id': self.t3.id, 'actions': 13},
+                          {'train_id': self.t2.id, 'actions': 9},
+                          {'train_id': t4.id, 'actions': 5}])
+        self.assertEqual(stats['timings'].keys(),
+                         ['load', 'simulate', 'write_back'])
+
+        # statistics collected in several processes are merged
+        manager = Manager.from_trains(trains, time(16,27), processes=2)
+        manager.stats = PredictionStats()
+        manager.simulate()
+        parallel = manager.stats.as_dict()
+        for key in ('journeys', 'actions', 'not_free', 'not_free_elements',
+                    'longest_journeys'):
+            self.assertEqual(parallel[key], stats[key])
+
+    def test_incremental(self):
+        """Test that only trains affected by changes are simulated again"""
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, self.t3, t4]
+
+        def _simulated(manager):
+            return sorted(j.train.nr for j in manager.journeys)
+
+        predictor = Predictor()
+        self.assertEqual(_simulated(predictor.run(time(16,10), trains)),
+                         [306, 2004, 4711])
+        self.assertEqual(_simulated(predictor.run(time(16,10), trains)), [])
+
+        # t4 doesn't share any elements with the other trains
+        t4_timetable[0].dep_real = time(16,20)
+        self.assertEqual(_simulated(predictor.run(time(16,10), trains)),
+                         [4711])
+
+        # no predictions before 16:21, so the passing time doesn't matter
+        self.assertEqual(_simulated(predictor.run(time(16,21), trains)), [])
+
+        # t2 shares XWF[1] with t3
+        self.t2_timetable['XWF'].dep_real = time(16,23,30)
+        self.assertEqual(_simulated(predictor.run(time(16,23,45), trains)),
+                         [306, 2004])
+
+        # t4 is predicted to arrive at XTS at 16:24, the others later
+        self.assertEqual(_simulated(predictor.run(time(16,24,30), trains)),
+                         [4711])
+
+        # the results are the same as those of a full run
+        incremental = [format_timetable(t) for t in trains]
+        Manager.from_trains(trains, time(16,24,30)).run()
+        self.assertEqual(incremental, [format_timetable(t) for t in trains])
+
+    def test_plans(self):
+        """Test that journey plans are reused until the timetable changes"""
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, self.t3, t4]
+        predictor = Predictor()
+        predictor.run(time(16,10), trains)
+        plans = dict(predictor.plans)
+        self.assertEqual(sorted(plans), sorted(t.id for t in trains))
+
+        # changed times only need the journey to be simulated again
+        self.t2_timetable['XWF'].dep_real = time(16,23,30)
+        manager = predictor.run(time(16,23,45), trains)
+        self.assertEqual(sorted(j.train.nr for j in manager.journeys),
+                         [306, 2004, 4711])
+        for j in manager.journeys:
+            self.assertIs(j.plan, plans[j.train_id])
+
+        # a changed track needs a new plan
+        self.t2_timetable['XCE'].track_want = 1
+        manager = predictor.run(time(16,23,45), trains)
+        self.assertIsNot(predictor.plans[self.t2.id], plans[self.t2.id])
+        self.assertIs(predictor.plans[self.t3.id], plans[self.t3.id])
+        self.assertEqual(predictor.plans[self.t2.id].stops[2].location,
+                         ('XCE', 1))
+
+        # trains that are gone are forgotten
+        predictor.run(time(16,23,45), [self.t2, self.t3])
+        self.assertNotIn(t4.id, predictor.plans)
+
+    def test_horizon(self):
+        """Test that trains beyond the near horizon are refreshed less often"""
+        t4, t4_timetable = self._add_separate_train()
+        self.assertEqual(get_trains_within_horizon(time(16,0), 600), [])
+        self.assertEqual(get_trains_within_horizon(time(16,0), 1200), [t4])
+        self.assertEqual(get_trains_within_horizon(time(23,0)), [])
+
+        config = dict(PREDICTION_NEAR_HORIZON=300,
+                      PREDICTION_FAR_REFRESH_INTERVAL=600,
+                      PREDICTION_STATS=True)
+        self.addCleanup(app.config.update,
+                        {k: app.config[k] for k in config})
+        app.config.update(config)
+
+        def _run(now):
+            manager = predictor.run(now)
+            return (manager.stats.horizon,
+                    sorted(j.train.nr for j in manager.journeys))
+
+        predictor = Predictor()
+        self.assertEqual(_run(time(16,15)), ('full', [306, 2004, 4711]))
+
+        # only t4 is within the near horizon, t3's change has to wait
+        self.t3_timetable['XCE'].track_want = 2
+        t4_timetable[1].track_want = 2
+        self.assertEqual(_run(time(16,17)), ('near', [4711]))
+        self.assertIn(self.t3.id, predictor.trains)
+        self.assertEqual(_run(time(16,18)), ('near', []))
+
+        horizon, simulated = _run(time(16,25))
+        self.assertEqual(horizon, 'full')
+        self.assertIn(306, simulated)
+
+    def test_near_run(self):
+        """Test that near runs predict the same as full runs"""
+        generate_session(300, now=time(12,0), seed=7)
+        config = dict(PREDICTION_NEAR_HORIZON=1800,
+                      PREDICTION_FAR_REFRESH_INTERVAL=300,
+                      PREDICTION_STATS=True)
+        self.addCleanup(app.config.update,
+                        {k: app.config[k] for k in config})
+        app.config.update(config)
+
+        predictor = Predictor()
+        predictor.run(time(12,0))
+        for now in (time(12,1), time(12,2), time(12,3)):
+            manager = predictor.run(now)
+            self.assertEqual(manager.stats.horizon, 'near')
+            self.assertTrue(manager.journeys)
+
+            full = Manager.from_trains(get_trains_within_horizon(now), now)
+            full.simulate()
+            # trains that just entered the horizon wait for the next full run
+            differences = [(j.train_id, stop.loc)
+                for j in full.journeys if j.train_id in predictor.trains
+                for stop in j.timetable
+                if (seconds2time(stop.arr_pred), seconds2time(stop.dep_pred))
+                    != (stop.entry.arr_pred, stop.entry.dep_pred)]
+            self.assertEqual(differences, [], now)
+
+    def test_budget(self):
+        """Test that the simulation stops when the budget runs out"""
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, self.t3, t4]
+
+        # the earliest actions are processed, even if other journeys don't
+        # share any elements: 16:20 and 16:24 of 4711, 16:23 of 2004
+        manager = Manager.from_trains(trains, time(16,10))
+        manager.step_budget = 3
+        manager.run()
+        self.assertEqual(self.t2_timetable['XWF'].dep_pred, time(16,23))
+        self.assertEqual(t4_timetable[1].arr_pred, time(16,24))
+        self.assertIsNone(t4_timetable[2].arr_pred)
+
+        Manager.from_trains(trains, time(16,10)).run()
+        complete = [format_timetable(t) for t in trains]
+
+        manager = Manager.from_trains(trains, time(16,10))
+        manager.stats = PredictionStats()
+        manager.step_budget = 4
+        manager.run()
+        self.assertEqual(manager.stats.actions, 4)
+        self.assertEqual(sorted(j.train.nr for j in manager.incomplete),
+                         [306, 2004, 4711])
+        self.assertTrue(all(j.incomplete for j in manager.journeys))
+        self.assertEqual(manager.occupied(), {})
+        # the earliest predictions are computed, the others are kept
+        self.assertEqual(self.t2_timetable['XWF'].dep_pred, time(16,23))
+        self.assertEqual([format_timetable(t) for t in trains], complete)
+
+        # incomplete trains are simulated again in the next run
+        self.addCleanup(app.config.update, PREDICTION_STEP_BUDGET=None,
+                        PREDICTION_STATS=app.config['PREDICTION_STATS'])
+        app.config.update(PREDICTION_STEP_BUDGET=4, PREDICTION_STATS=True)
+        predictor = Predictor()
+        manager = predictor.run(time(16,10), trains)
+        self.assertEqual(sorted(manager.stats.as_dict()['incomplete']),
+                         sorted(t.id for t in trains))
+        app.config['PREDICTION_STEP_BUDGET'] = None
+        manager = predictor.run(time(16,10), trains)
+        self.assertEqual(len(manager.journeys), 3)
+        self.assertEqual(manager.incomplete, [])
+
+    def _set_clock(self, state, now):
+        """Let the scheduler see `state` and `now` instead of the clock."""
+        self.addCleanup(setattr, scheduler, 'get_time', scheduler.get_time)
+        scheduler.get_time = lambda: (state, datetime.combine(date.today(),
+                                                              now))
+
+    def _patch_session(self, **methods):
+        """
+        Replace methods of `db.session`. The scheduler commits, but the
+        tests share a database and must not.
+        """
+        for name, method in methods.items():
+            self.addCleanup(vars(db.session).pop, name, None)
+            setattr(db.session, name, method)
+
+    def test_scheduler(self):
+        """Test that the scheduler skips runs while the clock is stopped"""
+        self._patch_session(commit=db.session.flush)
+        self.addCleanup(app.config.update,
+                        PREDICTION_STATS=app.config['PREDICTION_STATS'])
+        app.config['PREDICTION_STATS'] = True
+        sched = scheduler.PredictionScheduler(Predictor())
+        self.addCleanup(setattr, views, 'scheduler', views.scheduler)
+        views.scheduler = sched
+
+        self._set_clock('stopped', time(16,10))
+        self.assertFalse(sched.run())
+        self.assertIsNone(sched.last_run)
+        self.assertIsNone(sched.last_stats)
+
+        # requested runs are carried out anyway. The end of a request
+        # discards the session, so this comes first.
+        status = json.loads(self.app.get('/predict').data)
+        self.assertEqual(status['last_run'], time2js(time(16,10)))
+        self.assertEqual(status['last_trains'], 2)
+        self.assertEqual(status['last_incomplete'], 0)
+        self.assertIsNone(status['last_error'])
+        self.assertFalse(status['running'])
+        self.assertEqual(self.t2_timetable['XWF'].dep_pred, time(16,23))
+
+        stats = json.loads(self.app.get('/predict/stats').data)
+        self.assertEqual(stats, json.loads(json.dumps(sched.last_stats)))
+        self.assertEqual(stats['journeys'], 2)
+
+        self._set_clock('running', time(16,11))
+        self.assertTrue(sched.run())
+        self.assertEqual(sched.last_run.time(), time(16,11))
+
+        views.scheduler = scheduler.PredictionScheduler(Predictor())
+        self.assertEqual(json.loads(self.app.get('/predict/stats').data), {})
+
+    def test_scheduler_failed_commit(self):
+        """Test that trains are simulated again if writing them failed"""
+        def _fail():
+            raise RuntimeError('database is locked')
+        rollbacks = []
+        self._patch_session(commit=_fail,
+                            rollback=lambda: rollbacks.append(True))
+        sched = scheduler.PredictionScheduler(Predictor())
+        self._set_clock('running', time(16,10))
+        with self.assertRaises(RuntimeError):
+            sched.run()
+        self.assertEqual(sched.last_error, 'database is locked')
+        self.assertEqual(rollbacks, [True])
+
+        # otherwise the predictor would consider the trains up to date
+        db.session.commit = db.session.flush
+        self.assertTrue(sched.run())
+        self.assertEqual(sched.last_trains, 2)
+
+    def test_scenario(self):
+        """Test that scenarios are simulated without touching the database"""
+        t4, t4_timetable = self._add_separate_train()
+        trains = [self.t2, self.t3, t4]
+        predictor = Predictor()
+        predictor.run(time(16,10), trains)
+        stored = [format_timetable(t) for t in trains]
+
+        # t2 runs seven minutes late, so t3 has to wait for it at XWF
+        late = lambda t: t and timeadd(t, timedelta(minutes=7))
+        scenario = Scenario(predictor, {
+            e.id: {'arr_want': late(e.arr_want), 'dep_want': late(e.dep_want)}
+            for e in self.t2_timetable.values()})
+        changes = {(c['train_id'], c['loc']): c for c in scenario.run()}
+        self.assertEqual(sorted(j.train.nr for j in scenario.manager.journeys),
+                         [306, 2004])
+        self.assertEqual(changes[self.t2.id, 'XWF']['dep_pred'],
+                         (time(16,23), time(16,30)))
+        self.assertEqual(changes[self.t3.id, 'XWF']['dep_pred'],
+                         (time(16,30), time(16,34,1)))
+        self.assertNotIn((t4.id, 'XTS'), changes)
+
+        # the database and the predictor are left untouched
+        self.assertEqual(self.t2_timetable['XWF'].dep_want, time(16,23))
+        self.assertEqual([format_timetable(t) for t in trains], stored)
+        self.assertEqual(predictor.run(time(16,10), trains).journeys, [])
+
+        with self.assertRaises(ValueError):
+            Scenario(predictor, {self.t2_timetable['XWF'].id:
+                                 {'arr_pred': time(16,29)}})
+
+    def test_scenario_bad_input(self):
+        """Test that invalid scenario requests are rejected"""
+        elements = len(registry)
+        predictor = Predictor()
+        predictor.run(time(16,10), [self.t2, self.t3])
+        xce = self.t2_timetable['XCE'].id
+        for change in ({'dep_want': None}, {'track_want': None}):
+            with self.assertRaises(ValueError):
+                Scenario(predictor, {xce: change}).run()
+
+        # the end of a request discards the session, so this one, which
+        # needs the timetable, comes first
+        self.addCleanup(setattr, views, 'scheduler', views.scheduler)
+        views.scheduler = scheduler.PredictionScheduler(predictor)
+        rv = self.app.post('/predict/scenario', data=json.dumps({'changes': [
+            {'train_id': self.t2.id, 'loc': 'XCE', 'arr_want': None}]}))
+        self.assertEqual(rv.status_code, 400)
+
+        change = {'train_id': self.t2.id, 'loc': 'XWF'}
+        for changes in ([5], [dict(change, dep_want='abc')],
+                        [dict(change, track_want='zzz')],
+                        [dict(change, min_stoptime=1.5)],
+                        [dict(change, arr_pred=1430000000)],
+                        [dict(change, train_id=str(self.t2.id),
+                              track_want=2)],
+                        [{'loc': 'XWF', 'track_want': 2}], [change]):
+            rv = self.app.post('/predict/scenario',
+                               data=json.dumps({'changes': changes}))
+            self.assertEqual(rv.status_code, 400, changes)
+        self.assertEqual(len(registry), elements)
+
     #TODO test earliest_arrival and earliest_departure
 
+class TestGenerate(ZWLTestCase):
+    def setUp(self):
+        self._setup_database()
+
+    def test_generate_session(self):
+        created = generate_session(40, now=time(12,0), seed=1)
+        self.assertEqual(len(created), 40)
+        self.assertEqual(TimetableEntry.query.count(),
+                         sum(t.timetable_entries.count() for t in created))
+
+        timetables = get_timetables(created)
+        occupied = set()
+        for t in created:
+            timetable = timetables[t.id]
+            self.assertTrue(len(timetable) >= 2)
+            for e in timetable:
+                for real in (e.arr_real, e.dep_real):
+                    self.assertTrue(real is None or real <= time(12,0))
+
+            # no two trains are on the same track at the current time
+            elements = find_current_elements([
+                {k: v for k, v in vars(e).items() if v is not None}
+                for e in timetable])
+            self.assertFalse(elements & occupied)
+            occupied.update(elements)
+
+        # the same seed gives the same session
+        formatted = [format_timetable(t) for t in created]
+        db.session.rollback()
+        again = generate_session(40, now=time(12,0), seed=1)
+        self.assertEqual(formatted, [format_timetable(t) for t in again])
+
+        manager = Predictor().run(time(12,0))
+        self.assertTrue(manager.journeys)
+
+    def tearDown(self):
+        self._teardown_database()
+
 
 def format_timetable(train):
     out = ['loc    arr_want dep_want tr_w  arr_real dep_real tr_r  arr_pred dep_pred']
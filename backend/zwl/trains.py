@@ -11,12 +11,26 @@
 
 import itertools
 import operator
-from collections import defaultdict, deque, OrderedDict
+from collections import deque, OrderedDict
 from datetime import date, datetime, time
+from threading import Lock
+from time import time as ttime
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import ClauseElement
 from zwl import app, db
 from zwl.database import *
 from zwl.lines import get_lineconfig
-from zwl.utils import time2js
+from zwl.utils import time2js, time2seconds, seconds2time
+
+# columns `get_train_information` depends on, see `GraphDataCache`
+GRAPHDATA_COLUMNS = (
+    TrainType.id, TrainType.name, TrainType.category,
+    Train.id, Train.nr, Train.type_id,
+    Train.transition_from_id, Train.transition_to_id,
+    TimetableEntry.id, TimetableEntry.train_id, TimetableEntry.loc,
+    TimetableEntry.arr_plan, TimetableEntry.dep_plan,
+    TimetableEntry.track_plan, TimetableEntry.sorttime,
+)
 
 def get_train_ids_within_timeframe(starttime, endtime, line,
                                    startpos=0, endpos=1):
@@ -24,6 +38,17 @@ def get_train_ids_within_timeframe(starttime, endtime, line,
     Get IDs of about all trains that run on the given
     line within the given timeframe.
     """
+    q = train_ids_query(starttime, endtime, line, startpos, endpos)
+    train_ids = [row[0] for row in db.session.execute(q).fetchall()]
+
+    return train_ids
+
+
+def train_ids_query(starttime, endtime, line, startpos=0, endpos=1):
+    """
+    Get the query behind `get_train_ids_within_timeframe()`, which can be
+    used as a subquery, e.g. for `get_train_information()`.
+    """
     #TODO allow to filter for stations between xstart and xend
 
     line = get_lineconfig(line)
@@ -31,12 +56,40 @@ def get_train_ids_within_timeframe(starttime, endtime, line,
         line.locations_extended_between(startpos, endpos)}
 
     #TODO filter for stations on `line`
-    q = db.session.query(TimetableEntry.train_id).distinct() \
-        .filter(TimetableEntry.sorttime.between(starttime, endtime)) \
-        .filter(TimetableEntry.loc.in_(locations))
-    train_ids = [row[0] for row in db.session.execute(q).fetchall()]
+    return db.select([TimetableEntry.train_id]).distinct() \
+        .where(TimetableEntry.sorttime.between(starttime, endtime)) \
+        .where(TimetableEntry.loc.in_(locations))
 
-    return train_ids
+
+def get_graph_data(line, starttime, endtime, startpos=0, endpos=1):
+    """
+    Get the information about all trains running on `line` within the given
+    timeframe, i.e. `get_train_information()` for the trains found by
+    `get_train_ids_within_timeframe()`, using `graphdata_cache`. Both are
+    done in a single query.
+
+    The timeframe is widened to multiples of `GRAPHDATA_CACHE_QUANTUM`, so the
+    result may contain some trains running shortly before or after it.
+
+    :return: list of dicts, see `get_train_information()`
+    """
+    line = get_lineconfig(line)
+
+    quantum = app.config['GRAPHDATA_CACHE_QUANTUM']
+    if quantum:
+        start = time2seconds(starttime)
+        end = time2seconds(endtime) + (1 if endtime.microsecond else 0)
+        starttime = seconds2time(start - start % quantum)
+        end = min(end + (-end) % quantum, 24*60*60 - 1)
+        endtime = seconds2time(end)
+
+    def _compute():
+        train_ids = train_ids_query(starttime, endtime, line,
+            startpos=startpos, endpos=endpos)
+        return list(get_train_information(train_ids, line))
+
+    key = (line.id, starttime, endtime, startpos, endpos)
+    return graphdata_cache.get(key, _compute)
 
 
 def get_train_information(trains, line):
@@ -46,29 +99,22 @@ def get_train_information(trains, line):
     Note that trains that only "touch" one location on the line are not
     included (for example, trains that start on the last stop of the line)
 
-    @param trains: List of train ids or `Train` objects.
+    @param trains: List of train ids or `Train` objects, or a query
+                   selecting train ids (see `train_ids_query()`).
     @param line: `Line` object or line id.
     """
     line = get_lineconfig(line)
 
-    if not trains:
-        return
+    if not isinstance(trains, ClauseElement):
+        trains = [t if isinstance(t, (int, long)) else t.id for t in trains]
+        if not trains:
+            return
 
-    # fetch all trains and create a lookup dict of the form {id: Train}
-    #TODO: try to joinedload transition_{from,to}
-    trains = dict(db.session.query(Train.id, Train).filter(Train.id.in_(
-        (t if isinstance(t, (int, long)) else t.id) for t in trains)))
+    # fetch all trains along with their timetables in one query
+    records = get_train_records(trains, set(line.locationcodes))
 
-    # fetch all timetable entries we need in one query, sort them apart locally
-    timetable_entries = TimetableEntry.query \
-        .filter(TimetableEntry.train_id.in_(trains.keys())) \
-        .order_by(TimetableEntry.sorttime).all()
-    timetables = defaultdict(list)
-    for row in timetable_entries:
-        timetables[row.train_id].append(row)
-
-    for tid, train in trains.items():
-        segments = make_timetable(train, timetables[tid], line)
+    for train in records.values():
+        segments = make_timetable(train, train.timetable, line)
 
         if not segments:
             continue
@@ -79,18 +125,19 @@ def get_train_information(trains, line):
             'category': train.category,
             'nr': train.nr,
             'segments': segments,
-            'transition_to': train.transition_to_nr,
-            'transition_from': train.transition_from_nr,
+            'transition_to': train.transition_to,
+            'transition_from': train.transition_from,
             'comment': u'',
-            'start': timetables[tid][0].loc,
-            'end': timetables[tid][-1].loc,
+            'start': train.timetable[0].loc,
+            'end': train.timetable[-1].loc,
         }
 
 
 def make_timetable(train, timetable_entries, line):
     """
-    Parse the train's `timetable_entries` and generate timetable statements
-    for the given line.
+    Parse the train's `timetable_entries` (`TimetableEntry` objects or
+    `TimetableRecord`s) and generate timetable statements for the given
+    line.
     There may be several statements, because it is possible that a train
     appears multiple times on a line (e.g. if the line is a ring).
 
@@ -112,7 +159,14 @@ def make_timetable(train, timetable_entries, line):
     """
     # normally this is already sorted, but we better check that
     timetable_entries.sort(key=operator.attrgetter('sorttime'))
-    timetable_locations = [e.loc for e in timetable_entries]
+    # {location code: index of its first entry}, {index: entry}
+    timetable_index = {}
+    entries = {}
+    for i, e in enumerate(timetable_entries):
+        # records may be only a part of the timetable, see `TimetableRecord`
+        i = getattr(e, 'position', i)
+        timetable_index.setdefault(e.loc, i)
+        entries[i] = e
 
     def _add(seg, loc, tte, **kwargs):
         if loc.display_label:
@@ -137,9 +191,9 @@ def make_timetable(train, timetable_entries, line):
         # find the first stop within `line`
         while locations:
             loc = locations.popleft()
-            if loc.code in timetable_locations:
-                starti = timetable_locations.index(loc.code)
-                _add(cur_seg, loc, timetable_entries[starti])
+            starti = timetable_index.get(loc.code)
+            if starti is not None:
+                _add(cur_seg, loc, entries[starti])
                 break
 
         if starti is None:
@@ -147,22 +201,22 @@ def make_timetable(train, timetable_entries, line):
             break
 
         try:
-            i, loc = find_next_common_location(locations, timetable_locations, starti)
+            i, loc = find_next_common_location(locations, timetable_index, starti)
         except NoMatchFound:
             # there is no second location, discard this segment
-            print "train %d: No second stop found" % train.nr
+            app.logger.debug('train %d: no second stop found', train.nr)
             break
-        _add(cur_seg, loc, timetable_entries[i])
+        _add(cur_seg, loc, entries[i])
         direction = -1 if i < starti else +1
         cur_seg['direction'] = 'left' if i < starti else 'right'
 
         while locations:
             try:
-                i, loc = find_next_common_location(locations, timetable_locations, i, direction)
+                i, loc = find_next_common_location(locations, timetable_index, i, direction)
             except NoMatchFound:
                 break
 
-            _add(cur_seg, loc, timetable_entries[i])
+            _add(cur_seg, loc, entries[i])
 
         if direction == -1:
             cur_seg['timetable'].reverse()
@@ -172,13 +226,16 @@ def make_timetable(train, timetable_entries, line):
     return segments
 
 
-def find_next_common_location(locations, timetable_locations, starti,
+def find_next_common_location(locations, timetable_index, starti,
                               direction=None, loc_threshold=3, tt_threshold=3):
     """
-    Find the next common location appearing in both `locations` and
-    `timetable_locations` within the next `loc_threshold` locations and within
-    the next `tt_threshold` `timetable_locations`. Search starts at the
-    left end of `locations` and at index `starti` in `timetable_locations`.
+    Find the next common location appearing in both `locations` and the
+    timetable within the next `loc_threshold` locations and within the next
+    `tt_threshold` timetable entries. Search starts at the left end of
+    `locations` and at index `starti` in the timetable.
+
+    `timetable_index` maps the location codes of the timetable to their
+    (first) index, so every location is looked up in constant time.
     If `direction` is set, it must be `+1` or `-1`, and the search is limited
     to indexes higher resp. lower than `starti`.
 
@@ -187,7 +244,7 @@ def find_next_common_location(locations, timetable_locations, starti,
     If not, `locations` is reset to the state it had before.
 
     :return: A tuple of the form `(i, loc)` with
-             `i` being the index of the match in `timetable_locations` and
+             `i` being the index of the match in the timetable and
              `loc` being the matching object from `locations`.
     :raise NoMatchFound: if no match is found.
     """
@@ -215,9 +272,8 @@ def find_next_common_location(locations, timetable_locations, starti,
         loc = locations.popleft()
         pushback.appendleft(loc)
 
-        try:
-            i = timetable_locations.index(loc.code)
-        except ValueError:
+        i = timetable_index.get(loc.code)
+        if i is None:
             continue
 
         if _within_threshold(i):
@@ -227,5 +283,200 @@ def find_next_common_location(locations, timetable_locations, starti,
     locations.extendleft(pushback)
     raise NoMatchFound()
 
+def get_train_records(train_ids, locations=None):
+    """
+    Get the given trains as `TrainRecord`s and their timetables as
+    `TimetableRecord`s, reading only the columns `get_train_information`
+    needs in a single query, without creating ORM objects.
+
+    If `locations` (a set of location codes) is given, only the entries at
+    these locations and the first and last entry of every timetable are
+    included. The others are still read, as they are needed to determine
+    the positions of the records.
+
+    :param train_ids: list of train ids, or a query selecting them
+    :return: OrderedDict of the form {train id: `TrainRecord`}, ordered by
+             the trains' first entries. Timetables are sorted by `sorttime`.
+    """
+    tte = TimetableEntry
+    transition_from = aliased(Train)
+    transition_to = aliased(Train)
+    q = db.select([tte.loc, tte.arr_plan, tte.dep_plan, tte.track_plan,
+                   tte.sorttime, Train.id, Train.nr, TrainType.name,
+                   TrainType.category, transition_from.nr, transition_to.nr]) \
+        .select_from(db.join(tte, Train, tte.train_id == Train.id)
+            .outerjoin(TrainType, Train.type_id == TrainType.id)
+            .outerjoin(transition_from,
+                       Train.transition_from_id == transition_from.id)
+            .outerjoin(transition_to,
+                       Train.transition_to_id == transition_to.id)) \
+        .where(tte.train_id.in_(train_ids)).order_by(tte.sorttime)
+
+    trains = OrderedDict()
+    # {train id: (position, row)} of the last entry, if not included (yet)
+    skipped = {}
+    for row in db.session.execute(q):
+        train_id = row[5]
+        train = trains.get(train_id)
+        if train is None:
+            train = trains[train_id] = TrainRecord(*row[5:])
+        position = train.entries
+        train.entries += 1
+        if locations is None or position == 0 or row[0] in locations:
+            train.timetable.append(TimetableRecord(position, *row[:5]))
+            skipped.pop(train_id, None)
+        else:
+            skipped[train_id] = (position, row)
+
+    for train_id, (position, row) in skipped.items():
+        trains[train_id].timetable.append(TimetableRecord(position, *row[:5]))
+    return trains
+
+
+class TrainRecord(object):
+    """
+    The data of a `Train` needed by `get_train_information`, see
+    `get_train_records`. `transition_from` and `transition_to` are train
+    numbers, `entries` is the number of entries of the whole timetable.
+    """
+    __slots__ = ('id', 'nr', 'type', 'category', 'transition_from',
+                 'transition_to', 'timetable', 'entries')
+
+    def __init__(self, id, nr, type, category, transition_from,
+                 transition_to):
+        self.id = id
+        self.nr = nr
+        self.type = type
+        self.category = category
+        self.transition_from = transition_from
+        self.transition_to = transition_to
+        self.timetable = []
+        self.entries = 0
+
+    def __repr__(self):
+        return '<TrainRecord #%s (%s %s)>' % (self.id, self.type, self.nr)
+
+
+class TimetableRecord(object):
+    """
+    The data of a `TimetableEntry` needed by `make_timetable`, see
+    `get_train_records`. `position` is the index of the entry in the
+    whole timetable, as there may be fewer records than entries.
+    """
+    __slots__ = ('position', 'loc', 'arr_plan', 'dep_plan', 'track_plan',
+                 'sorttime')
+
+    def __init__(self, position, loc, arr_plan, dep_plan, track_plan,
+                 sorttime):
+        self.position = position
+        self.loc = loc
+        self.arr_plan = arr_plan
+        self.dep_plan = dep_plan
+        self.track_plan = track_plan
+        self.sorttime = sorttime
+
+    def __repr__(self):
+        return '<TimetableRecord %d: %s>' % (self.position, self.loc)
+
+
 class NoMatchFound(ValueError):
     pass
+
+
+class GraphDataCache(object):
+    """
+    Cache for the results of `get_graph_data()`, keeping the `size` most
+    recently used ones.
+
+    All results are dropped as soon as the timetable changes. To notice this,
+    a checksum of `GRAPHDATA_COLUMNS` (see `zwl.database.checksum`) is
+    queried on every lookup, or only every `GRAPHDATA_CACHE_CHECK_INTERVAL`
+    seconds. Predictions are not part of the results, so prediction runs
+    don't invalidate the cache.
+    """
+    def __init__(self, size=None):
+        self._size = size
+        self._results = OrderedDict()
+        self._signal = None
+        self._checked = None
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def size(self):
+        if self._size is not None:
+            return self._size
+        return app.config['GRAPHDATA_CACHE_SIZE']
+
+    def get(self, key, compute):
+        """
+        Get the result stored for `key`. If there is none, it is computed
+        using `compute()` and stored.
+        """
+        if not self.size:
+            self.misses += 1
+            return compute()
+
+        signal = self._check()
+        with self._lock:
+            if key in self._results:
+                # move it to the end, it's the most recently used one now
+                result = self._results.pop(key)
+                self._results[key] = result
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = compute()
+
+        with self._lock:
+            # don't store it if the cache has been invalidated meanwhile
+            if signal == self._signal:
+                self._results[key] = result
+                while len(self._results) > self.size:
+                    self._results.popitem(last=False)
+                    self.evictions += 1
+        return result
+
+    def _check(self):
+        """
+        Drop all results if the timetable has changed.
+
+        :return: the current change signal
+        """
+        interval = app.config['GRAPHDATA_CACHE_CHECK_INTERVAL']
+        if self._checked is not None and ttime() - self._checked < interval:
+            return self._signal
+
+        signal = checksum(*GRAPHDATA_COLUMNS)
+        with self._lock:
+            self._checked = ttime()
+            if signal != self._signal:
+                if self._results:
+                    self.invalidations += 1
+                self._results.clear()
+                self._signal = signal
+        return signal
+
+    def clear(self):
+        """Drop all results."""
+        with self._lock:
+            self._results.clear()
+            self._signal = None
+            self._checked = None
+
+    def stats(self):
+        return dict(
+            size=len(self._results),
+            max_size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+graphdata_cache = GraphDataCache()
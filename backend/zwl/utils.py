@@ -12,7 +12,7 @@
 import socket
 import warnings
 from contextlib import contextmanager
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, time, timedelta
 from zwl import app
 
 def time2js(t):
@@ -36,6 +36,29 @@ def js2time(s):
     #TODO after-midnight and weekday treatment
     return datetime.fromtimestamp(float(s)).time()
 
+def time2seconds(t):
+    """
+    Convert a datetime.time object to the number of seconds since midnight,
+    as used by the prediction engine.
+    """
+    if t is None:
+        return None
+
+    #TODO after-midnight treatment
+    return t.hour*3600 + t.minute*60 + t.second
+
+def seconds2time(s):
+    """
+    Convert a number of seconds since midnight to a datetime.time object.
+    Values of a day or more wrap around to the next day.
+    """
+    if s is None:
+        return None
+
+    minutes, second = divmod(int(s), 60)
+    hour, minute = divmod(minutes, 60)
+    return time(hour % 24, minute, second)
+
 def timediff(a, b):
     """
     `a - b` for `datetime.time` objects.
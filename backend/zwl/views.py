@@ -12,13 +12,14 @@
 import os
 from datetime import datetime, time
 from flask import abort, send_from_directory, Response, json, request, jsonify
-from time import sleep, time as ttime
+from time import sleep
 from werkzeug.exceptions import NotFound
-from zwl import app, db
-from zwl.database import Train
+from zwl import app
+from zwl.database import TimetableEntry
 from zwl.lines import lineconfigs, get_lineconfig
-from zwl.predict import Manager
-from zwl.trains import get_train_ids_within_timeframe, get_train_information
+from zwl.predict import Scenario
+from zwl.scheduler import scheduler
+from zwl.trains import get_graph_data, graphdata_cache
 from zwl.utils import js2time, time2js, get_time
 
 
@@ -45,18 +46,111 @@ def line_info():
 
 @app.route('/predict')
 def predict():
-    start = ttime()
+    """
+    Request an update of the predictions and report the state of the last
+    one. If the scheduler is not running, the update is done immediately.
+    """
+    if scheduler.started:
+        scheduler.trigger()
+    else:
+        scheduler.run(force=True)
+    return jsonify(**scheduler.status())
+
+
+@app.route('/predict/stats')
+def predict_stats():
+    """Report counters and timings of the last prediction run."""
+    return jsonify(**(scheduler.last_stats or {}))
+
+
+@app.route('/predict/scenario', methods=['POST'])
+def predict_scenario():
+    """
+    Predict the consequences of hypothetical changes of the timetable data,
+    without storing anything. The request body is JSON of the form
+
+        {"changes": [{"train_id": 12, "loc": "XWF", "dep_want": 1430000000},
+                     {"train_id": 12, "loc": "XCE", "track_want": 3}]}
+
+    with times in the frontend's format. Attributes that can be changed are
+    listed in `Scenario.FIELDS`. The predictions that differ from the
+    stored ones are returned.
+    """
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('changes'), list):
+        abort(400)
+
+    overrides = {}
+    for change in data['changes']:
+        try:
+            train_id, loc, change = _parse_scenario_change(change)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            abort(400)
+        entry = TimetableEntry.query.filter_by(train_id=train_id, loc=loc) \
+            .first()
+        if entry is None:
+            abort(404)
+        overrides.setdefault(entry.id, {}).update(change)
+
+    predictor = scheduler.predictor
+    if predictor.now is None and not scheduler.run(force=True):
+        # there is nothing to compare with yet
+        abort(503)
+    scenario = Scenario(predictor, overrides)
+    try:
+        changes = scenario.run()
+    except ValueError:
+        abort(400)
 
-    Manager.from_timestamp(time(14,10)).run()
-    db.session.commit()
+    return jsonify(
+        now=time2js(scenario.now),
+        trains=len(scenario.manager.journeys),
+        changes=[dict(c, arr_pred=map(time2js, c['arr_pred']),
+                      dep_pred=map(time2js, c['dep_pred']))
+                 for c in changes],
+    )
 
-    end = ttime()
 
-    return Response('done (%fs)' % (end - start), mimetype='text/plain')
+def _parse_scenario_change(change):
+    """
+    Check one change requested from `predict_scenario`, converting the
+    times.
+
+    :return: tuple `(train_id, loc, {attribute: value})`
+    :raise ValueError: (or KeyError, TypeError) if the change is invalid
+    """
+    change = dict(change)
+    train_id = change.pop('train_id')
+    loc = change.pop('loc')
+    if not isinstance(train_id, (int, long)) or isinstance(train_id, bool) \
+            or not isinstance(loc, basestring):
+        raise ValueError('invalid train_id or loc')
+    if not change or not set(change) <= set(Scenario.FIELDS):
+        raise ValueError('invalid attributes %r' % change.keys())
+
+    for name, value in change.items():
+        if value is None:
+            continue
+        if name.startswith(('arr_', 'dep_')):
+            # numeric timestamps only, js2time would accept strings too
+            if not isinstance(value, (int, long, float)) \
+                    or isinstance(value, bool):
+                raise ValueError('%s must be a time' % name)
+            change[name] = js2time(value)
+        elif not isinstance(value, (int, long)) or isinstance(value, bool):
+            # tracks and minimum times
+            raise ValueError('%s must be an integer' % name)
+    return train_id, loc, change
+
+
+@app.route('/graphdata/cache')
+def graphdata_cache_stats():
+    """Report the counters of the graph data cache."""
+    return jsonify(**graphdata_cache.stats())
 
 
 @app.route('/graphdata/<line>.json')
-def get_graph_data(line):
+def graph_data(line):
     sleep(app.config['RESPONSE_DELAY'])
 
     if line == 'sample':
@@ -123,12 +217,8 @@ def get_graph_data(line):
     startpos = request.args.get('startpos', 0, float)
     endpos = request.args.get('endpos', 1, float)
 
-    train_ids = list(get_train_ids_within_timeframe(
-        starttime, endtime, line, startpos=startpos, endpos=endpos))
-    trains = Train.query.filter(Train.id.in_(train_ids)).all() if train_ids else []
-
     return jsonify(
-        trains=list(get_train_information(trains, line)),
+        trains=get_graph_data(line, starttime, endtime, startpos, endpos),
         line=line.id,
         starttime=time2js(starttime),
         endtime=time2js(endtime),